@@ -21,6 +21,8 @@
 #     "after_commands": (optional) array of bash commands to run after freezing,
 #     "before_commands": (optional) array of bash commands to run before freezing,
 #     "description": (optional) an optional description will be appended to the description of the backup voulmes
+#     "command_timeout": (optional) seconds a before or after command may run before it is killed, 600 by default
+#     "consistency_group": (optional) entries with the same consistency_group are frozen together, in order of path, snapshotted at once with the same Backup-Datetime, then unfrozen together
 #   }
 # }
 #
@@ -41,6 +43,13 @@
 #   }
 # }
 # 
+# Copying snapshots to another region:
+# Run with --copy-region us-west-2 to copy this instance's snapshots to that
+# region after backing up, or with --copy-only --copy-region us-west-2 to only
+# copy, such as from a separate cron entry.  Copies are tagged with the id of
+# the snapshot they came from, so a snapshot is only ever copied once, and
+# the copies are pruned with the same hourly/daily/weekly/monthly counts.
+#
 # Important:
 #   A best practice generally is to test third party scripts on a test account before
 #   running them on anything important.  This is especially true in this case, because
@@ -56,25 +65,33 @@
 from __future__ import print_function
 
 # Standard Modules
+from collections import namedtuple
+import argparse
 import datetime
-import email.mime.text
 import logging
 import json
 import re
-import smtplib
 import sys
+import threading
+import time
 
 # Local Modules
 import common
 
 _BACKUP_CONFIG_FILE = "backup_config.json"
+_COMMAND_TIMEOUT = 600  # seconds
+_COPY_TIMEOUT = 21600  # seconds
 _DATETIME_FORMAT = "%Yy-%mm-%dd %Hh%Mm"
 _DEBUG = True
 _EMAIL_RECIPIENT = ""  # *REPLACE* Your recipient's email address goes here.
 _EMAIL_SENDER = ""  # *REPLACE* Your sender's email address goes here.
+_FREEZE_TIMEOUT = 60  # seconds
 _FSTAB_PATH = "/etc/fstab"
 _LOG_FILE_NAME = "backup.log"
 _LOG_LEVEL = logging.DEBUG
+_MAX_CONCURRENT_COPIES = 20  # per destination region
+_MDADM_TIMEOUT = 60  # seconds
+_SOURCE_SNAPSHOT_TAG = "Backup-Source-Snapshot"
 _TIMING_MAP = {
   "minutely": datetime.timedelta(minutes=1),  # Useful for testing, not intended for real use.
   "hourly": datetime.timedelta(hours=1),
@@ -84,7 +101,13 @@ _TIMING_MAP = {
 }
 _USERNAME = "ec2-user"
 
-logging.basicConfig(filename=_LOG_FILE_NAME, level=_LOG_LEVEL)
+_SnapshotJob = namedtuple("_SnapshotJob", [
+  "volume_id",
+  "description",
+  "tags",
+  "snapshots",  # the existing snapshots of the same type, to prune
+  "max_backups"
+])
 
 
 class Freezer(object):
@@ -113,9 +136,11 @@ class Freezer(object):
 
     _log("Freezing {}".format(storage.mount_point))
     freeze_command = Freezer.FREEZE_COMMANDS[storage.file_system_type]
-    common.run_command(freeze_command.replace("_REPLACED_WITH_MOUNT_POINT",
-      storage.mount_point))
+    # Tracked first, since a freeze that failed or timed out may still have
+    # frozen it, and unfreeze_all must then thaw it.
     self.frozen.append(storage)
+    _check_command(freeze_command.replace("_REPLACED_WITH_MOUNT_POINT",
+      storage.mount_point), _FREEZE_TIMEOUT)
 
   def unfreeze(self, storage):
     """Unfreezes the disk mounted to a mount point."""
@@ -127,14 +152,14 @@ class Freezer(object):
 
     _log("Unfreezing {}".format(storage.mount_point))
     unfreeze_command = Freezer.UNFREEZE_COMMANDS[storage.file_system_type]
-    common.run_command(unfreeze_command.replace("_REPLACED_WITH_MOUNT_POINT",
-      storage.mount_point))
+    _check_command(unfreeze_command.replace("_REPLACED_WITH_MOUNT_POINT",
+      storage.mount_point), _FREEZE_TIMEOUT)
     self.frozen.remove(storage)
 
   def unfreeze_all(self):
     """Unfreezes all disks that are still frozen."""
     _log("Unfreezing all")
-    for storage in self.frozen:
+    for storage in list(reversed(self.frozen)):
       try:
         self.unfreeze(storage)
       except Exception, err:
@@ -167,7 +192,22 @@ class Storage(object):
     self.file_system_type, self.is_raid)
 
 
-def main():  # pylint: disable=R0914
+def main():
+  parser = argparse.ArgumentParser(
+    description="Snapshots the volumes listed in {}.".format(
+      _BACKUP_CONFIG_FILE))
+  parser.add_argument("--copy-region",
+                      help="copies this instance's snapshots to this region "
+                           "after backing up, and prunes the copies there")
+  parser.add_argument("--copy-only", action="store_true",
+                      help="only copies snapshots to --copy-region, without "
+                           "taking new ones")
+  options = parser.parse_args()
+  if options.copy_only and not options.copy_region:
+    parser.error("--copy-only needs --copy-region")
+
+  logging.basicConfig(filename=_LOG_FILE_NAME, level=_LOG_LEVEL)
+
   _log("Running backup script. It is now {}".format(
     datetime.datetime.now().strftime(_DATETIME_FORMAT)))
 
@@ -178,83 +218,145 @@ def main():  # pylint: disable=R0914
   self_instance = common.get_self_instance(connection)
   self_instance_name = (self_instance.tags['Name'] if 'Name' in
                         self_instance.tags else self_instance_id)
-  attached_volumes = _get_attached_volumes(connection, self_instance_id)
   mounted_storages = _get_mounted_storages()
-  freezer = Freezer()
 
-  for name, rules in config.iteritems():
+  if not options.copy_only:
+    _back_up(connection, config, self_instance_id, self_instance_name,
+             mounted_storages)
+
+  if options.copy_region:
     try:
-      path = rules['path']
-      if rules['path'] not in mounted_storages:
-        raise Exception("Cannot find mount for {}".format(path))
-
-      extra_description = (rules['description'] if 'description' in rules
-                           else "")
-      storage = mounted_storages[path]
-
-      _run_before_commands(rules)
-
-      volume_ids = []
-      for device in storage.devices:
-        volume = _get_volume_used_by_device(device, attached_volumes)
-        if not volume:
-          raise Exception("Cannot find volume attached to {}".format(
-          device))
-        volume_ids.append({
-          "device": device,
-          "volume_id": volume.id,
-        })
-
-      _log("Preparing to back up {}".format(storage.mount_point))
-      freezer.freeze(storage)
-      for timing_rule in _TIMING_MAP:
-        if timing_rule in rules:
-          snapshots = _get_snapshots(connection, self_instance_name,
-            timing_rule)
-          if len(snapshots):
-            # Check if we already took a recent snapshot for this duration
-            most_recent_dt_string = snapshots[0].tags['Backup-Datetime']
-            most_recent_dt = datetime.datetime.strptime(most_recent_dt_string,
-              _DATETIME_FORMAT)
-            now_dt = datetime.datetime.now()
-            duration_between_backups = _TIMING_MAP[timing_rule]
-            if now_dt - most_recent_dt < duration_between_backups:
-              _log("Not snapshotting {} / {} because it's too soon.".format(
-                name, timing_rule))
-              continue
-
-          for vol_and_device in volume_ids:
-            volume_id = vol_and_device['volume_id']
-            device = vol_and_device['device']
-
-            snap_datetime = datetime.datetime.now().strftime(_DATETIME_FORMAT)
-            full_desc = _build_full_description(name, self_instance_id,
-              snap_datetime, timing_rule, storage, device,
-              extra_description)
-            short_name = " ".join([self_instance_name, timing_rule,
-              device.replace("/dev/", ""), snap_datetime])
-
-            _snapshot_volume(connection, volume_id, full_desc, {
-              'Name': short_name,
-              'Backup-Datetime': snap_datetime,
-              'Backup-Device': device,
-              'Backup-Instance-Name': self_instance_name,
-              'Backup-Type': timing_rule
-            })
-
-            _delete_old_snapshots(connection, snapshots, timing_rule, device,
-                                  int(rules[timing_rule]))
+      _copy_snapshots(connection, options.copy_region, self_instance_name,
+                      _get_device_rules(config, mounted_storages))
+    except Exception, err:
+      _error(err)
 
-      freezer.unfreeze(storage)
 
-      _run_after_commands(rules)
+def _back_up(connection, config, self_instance_id, self_instance_name,
+             mounted_storages):
+  """Snapshots the storage of each entry in config that is due, one
+  consistency group at a time, and prunes its old snapshots."""
+  attached_volumes = _get_attached_volumes(connection, self_instance_id)
+  freezer = Freezer()
 
+  for entries in _get_consistency_groups(config):
+    try:
+      _back_up_group(connection, entries, self_instance_id,
+                     self_instance_name, attached_volumes, mounted_storages,
+                     freezer)
     except Exception, err:
       _error(err)
     finally:
       freezer.unfreeze_all()
 
 
+def _back_up_group(connection, entries, self_instance_id,
+                   self_instance_name, attached_volumes, mounted_storages,
+                   freezer):  # pylint: disable=R0913,R0914
+  """Snapshots the storage of entries, a list of (name, rules) from the
+  config, as one consistency group. The due snapshots are worked out first,
+  then every mount is frozen in order of mount point, all the snapshots are
+  started at once with one shared Backup-Datetime, and the mounts are
+  unfrozen in reverse order. Tagging and pruning happen after unfreezing.
+  If any snapshot failed, the ones that were taken are still tagged, but
+  nothing is pruned."""
+  snap_datetime = datetime.datetime.now().strftime(_DATETIME_FORMAT)
+  storages = []
+  jobs = []
+
+  for name, rules in entries:
+    path = rules['path']
+    if rules['path'] not in mounted_storages:
+      raise Exception("Cannot find mount for {}".format(path))
+
+    extra_description = (rules['description'] if 'description' in rules
+                         else "")
+    storage = mounted_storages[path]
+    storages.append(storage)
+
+    _run_before_commands(rules)
+
+    volume_ids = []
+    for device in storage.devices:
+      volume = _get_volume_used_by_device(device, attached_volumes)
+      if not volume:
+        raise Exception("Cannot find volume attached to {}".format(
+        device))
+      volume_ids.append({
+        "device": device,
+        "volume_id": volume.id,
+      })
+
+    for timing_rule in _TIMING_MAP:
+      if timing_rule in rules:
+        snapshots = _get_snapshots(connection, self_instance_name,
+          timing_rule)
+        storage_snapshots = [snapshot for snapshot in snapshots
+                             if snapshot.tags['Backup-Device'] in
+                             storage.devices]
+        if len(storage_snapshots):
+          # Check if we already took a recent snapshot for this duration
+          most_recent_dt_string = storage_snapshots[0].tags['Backup-Datetime']
+          most_recent_dt = datetime.datetime.strptime(most_recent_dt_string,
+            _DATETIME_FORMAT)
+          now_dt = datetime.datetime.now()
+          duration_between_backups = _TIMING_MAP[timing_rule]
+          if now_dt - most_recent_dt < duration_between_backups:
+            _log("Not snapshotting {} / {} because it's too soon.".format(
+              name, timing_rule))
+            continue
+
+        for vol_and_device in volume_ids:
+          device = vol_and_device['device']
+          full_desc = _build_full_description(name, self_instance_id,
+            snap_datetime, timing_rule, storage, device,
+            extra_description)
+          short_name = " ".join([self_instance_name, timing_rule,
+            device.replace("/dev/", ""), snap_datetime])
+
+          jobs.append(_SnapshotJob(vol_and_device['volume_id'], full_desc, {
+            'Name': short_name,
+            'Backup-Datetime': snap_datetime,
+            'Backup-Device': device,
+            'Backup-Instance-Name': self_instance_name,
+            'Backup-Type': timing_rule
+          }, snapshots, int(rules[timing_rule])))
+
+  if jobs:
+    storages.sort(key=lambda storage: storage.mount_point)
+    _log("Preparing to back up {}".format(", ".join(
+      storage.mount_point for storage in storages)))
+
+    freeze_start = time.time()
+    for storage in storages:
+      freezer.freeze(storage)
+    new_snapshots = _create_snapshots(connection, jobs)
+    for storage in reversed(storages):
+      freezer.unfreeze(storage)
+    _log("Froze {} for {:.2f} seconds".format(", ".join(
+      storage.mount_point for storage in storages),
+      time.time() - freeze_start))
+
+    for job, snapshot in zip(jobs, new_snapshots):
+      if snapshot:
+        connection.create_tags([snapshot.id], job.tags)
+        _log("Snapshot {} taken of volume {}".format(snapshot.id,
+                                                      job.volume_id))
+
+    failed_volume_ids = [job.volume_id for job, snapshot
+                         in zip(jobs, new_snapshots) if not snapshot]
+    if failed_volume_ids:
+      raise Exception("Error taking snapshot for volumes {}".format(
+        ", ".join(failed_volume_ids)))
+
+    for job in jobs:
+      _delete_old_snapshots(connection, job.snapshots,
+                            job.tags['Backup-Type'],
+                            job.tags['Backup-Device'], job.max_backups)
+
+  _run_after_commands(entries)
+
+
 def _build_full_description(name, instance_id, snap_datetime, backup_type,
   storage, device, extra_description):
   primary_device = storage.primary_device_name
@@ -270,6 +372,124 @@ def _build_full_description(name, instance_id, snap_datetime, backup_type,
   return full_desc
 
 
+def _check_command(command, timeout):
+  """Runs command locally, killing it after timeout seconds, and returns its
+  output. Raises an exception if it failed or timed out."""
+  result = common.run_local(command, timeout)
+  _log_command_result(result)
+  if result.timed_out or result.status:
+    raise Exception("{} failed with exit status {}: {}".format(
+      result.command, result.status, result.output))
+
+  return result.output
+
+
+def _copy_snapshots(connection, region_name, instance_name, device_rules):
+  """Copies the completed snapshots of instance_name that haven't been
+  copied yet to the region named region_name, then prunes the copies there
+  with the counts in device_rules, a dict of device to its config rules.
+  At most _MAX_CONCURRENT_COPIES snapshots of ours are pending in the
+  region at once, counting other instances' copies and ones earlier runs
+  started, and the rest are queued until one finishes. Each copy is tagged
+  in the same request that starts it, so one that started is never copied
+  again. Copies are tracked with one request per poll."""
+  destination = common.connect_region(region_name)
+  source_region_name = connection.region.name
+
+  copies = destination.get_all_snapshots(owner="self", filters={
+    'tag:Backup-Instance-Name': instance_name,
+    'tag-key': _SOURCE_SNAPSHOT_TAG
+  })
+  # Failed copies are left for someone to look at, and copied again.
+  copied_ids = set(copy.tags[_SOURCE_SNAPSHOT_TAG] for copy in copies
+                   if copy.status != "error")
+  pending_ids = set(snapshot.id for snapshot in destination.get_all_snapshots(
+    owner="self", filters={'status': "pending"}))
+
+  queue = []
+  for timing_rule in _TIMING_MAP:
+    queue.extend(snapshot for snapshot in
+                 _get_snapshots(connection, instance_name, timing_rule)
+                 if snapshot.status == "completed" and
+                 snapshot.id not in copied_ids)
+  _log("Copying {} snapshots to {}, {} snapshots already pending".format(
+    len(queue), region_name, len(pending_ids)))
+
+  def check():
+    if pending_ids:
+      for copy in destination.get_all_snapshots(
+          snapshot_ids=list(pending_ids)):
+        if copy.status != "pending":
+          _log("Snapshot {} is {}".format(copy.id, copy.status))
+          pending_ids.discard(copy.id)
+
+    while queue and len(pending_ids) < _MAX_CONCURRENT_COPIES:
+      snapshot = queue.pop(0)
+      tags = dict(snapshot.tags)
+      tags[_SOURCE_SNAPSHOT_TAG] = snapshot.id
+      params = {
+        'Description': snapshot.description,
+        'SourceRegion': source_region_name,
+        'SourceSnapshotId': snapshot.id,
+        'TagSpecification.1.ResourceType': "snapshot"
+      }
+      for index, (key, value) in enumerate(sorted(tags.iteritems()), 1):
+        params['TagSpecification.1.Tag.{}.Key'.format(index)] = key
+        params['TagSpecification.1.Tag.{}.Value'.format(index)] = value
+      copy_id = common.call_ec2_api(destination, "CopySnapshot",
+                                    params).findtext("snapshotId")
+      _log("Copying snapshot {} to {} as {}".format(snapshot.id, region_name,
+                                                    copy_id))
+      pending_ids.add(copy_id)
+
+    return not queue and not pending_ids
+
+  try:
+    common.wait_for(check, "snapshot copies to {}".format(region_name),
+                    _COPY_TIMEOUT)
+  except common.WaitTimeout, err:
+    raise common.WaitTimeout("{}, with {} queued and {} pending".format(
+      err, len(queue), len(pending_ids)))
+
+  for timing_rule in _TIMING_MAP:
+    # Failed copies keep their Backup-* tags but mustn't count as backups,
+    # or pruning would delete good copies to make room for them.
+    copies = [copy for copy in
+              _get_snapshots(destination, instance_name, timing_rule)
+              if copy.status == "completed"]
+    for device in set(copy.tags['Backup-Device'] for copy in copies):
+      if device in device_rules and timing_rule in device_rules[device]:
+        # Unlike a backup, every copy is already in the list, hence the + 1.
+        _delete_old_snapshots(destination, copies, timing_rule, device,
+                              int(device_rules[device][timing_rule]) + 1)
+
+
+def _create_snapshots(connection, jobs):
+  """Starts a snapshot for each _SnapshotJob in jobs at the same time, each
+  from its own thread and connection, so frozen mounts aren't kept waiting
+  on one request after another. Returns the new snapshots in the same
+  order, with None for any that failed."""
+  snapshots = [None] * len(jobs)
+  connections = [common.connect(connection.region) for _ in jobs]
+
+  def work(index):
+    try:
+      snapshots[index] = connections[index].create_snapshot(
+        jobs[index].volume_id, jobs[index].description)
+    except Exception, err:  # pylint: disable=W0703
+      logging.error("Snapshot of {} failed: {}".format(jobs[index].volume_id,
+                                                       err))
+
+  threads = [threading.Thread(target=work, args=(index,))
+             for index in range(len(jobs))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  return snapshots
+
+
 def _delete_old_snapshots(connection, snapshots, backup_type, device,
                           max_backups=1000000):
   """Prunes the snapshots by ensuring that there are at most max_backups
@@ -298,6 +518,11 @@ def _email(subject, body):
     return
   if not _EMAIL_SENDER:
     return
+
+  # Imported here, as most runs never send an email.
+  import email.mime.text
+  import smtplib
+
   message_content = "Backup script message!<br/>"
   message_content += "from instance id {}<br/>--<br/><br/>".format(
     common.get_self_instance_id())
@@ -363,10 +588,45 @@ def _get_attached_volumes(connection, instance_id=None):
   return attached_volumes
 
 
+def _get_consistency_groups(config):
+  """Returns the entries of config as lists of (name, rules) to back up
+  together: one list per consistency_group, then one per entry without
+  one."""
+  groups = {}
+  singles = []
+  for name, rules in sorted(config.iteritems()):
+    if 'consistency_group' in rules:
+      groups.setdefault(rules['consistency_group'], []).append((name, rules))
+    else:
+      singles.append([(name, rules)])
+
+  return [groups[group] for group in sorted(groups)] + singles
+
+
+def _get_device_rules(config, mounted_storages):
+  """Returns a dict of each device backed up to the rules in config for the
+  storage it's part of."""
+  device_rules = {}
+  for rules in config.itervalues():
+    if rules['path'] in mounted_storages:
+      for device in mounted_storages[rules['path']].devices:
+        device_rules[device] = rules
+
+  return device_rules
+
+
 def _get_mounted_storages():
   """Returns a dictionary of Storage objects, indexed by their
   mount_point.  The Storage objects are found using the fstab."""
-  fstab_info = common.run_command("cat {}".format(_FSTAB_PATH)).split("\n")
+  with open(_FSTAB_PATH, "r") as fstab_file:
+    fstab_info = fstab_file.read().split("\n")
+  # Hosts without mdadm have no arrays, so a failed scan is fine.
+  scan = common.run_local(["sudo", "mdadm", "--detail", "--scan"],
+                          _MDADM_TIMEOUT)
+  _log_command_result(scan)
+  if scan.timed_out:
+    raise Exception("{} timed out".format(scan.command))
+  mdadms = scan.output if scan.status == 0 else ""
   storages = {}
   for line in fstab_info:
     trimmed_line = line.strip()
@@ -384,12 +644,11 @@ def _get_mounted_storages():
       storage.file_system_type = matched_fs_info.group(3)
 
     # Now check if this is a RAID array
-    mdadms = common.run_command("sudo mdadm --detail --scan")
     if "ARRAY {}".format(storage.primary_device_name) in mdadms:
       storage.is_raid = True
       # Now find a full listing of ALL the devices used
-      raid_device_info = common.run_command("sudo mdadm --detail {}".format(
-        storage.primary_device_name)).split("\n")
+      raid_device_info = _check_command(["sudo", "mdadm", "--detail",
+        storage.primary_device_name], _MDADM_TIMEOUT).split("\n")
       for line in raid_device_info:
         # We are pulling the devices off of the lines that look like this:
         #   0     202       97        0      active sync   /dev/sdg1
@@ -433,38 +692,40 @@ def _log(message):
   logging.info(message)
 
 
-def _run_commands(commands):
-  for command in commands:
-    _log("Running custom command {}".format(command))
-    common.run_command(command)
+def _log_command_result(result):
+  """Logs how long a command took and how it finished, as an error if it
+  failed or timed out."""
+  message = "{} took {:.2f} seconds and exited with {}".format(
+    result.command, result.seconds, result.status)
+  if result.timed_out:
+    logging.error("{} timed out".format(message))
+  elif result.status:
+    logging.error("{}: {}".format(message, result.output))
+  else:
+    _log(message)
 
 
-def _run_after_commands(rules):
+def _run_after_commands(entries):
+  """Runs the after_commands of entries, a list of (name, rules) backed up
+  together. Each entry's commands run in order, and different entries' run
+  at the same time, since they're for different mounts."""
   _log("Running any after commands specified in the config")
-  after_commands = (rules['after_commands'] if 'after_commands' in rules
-                    else [])
-  _run_commands(after_commands)
+  command_lists = [rules.get('after_commands', []) for _, rules in entries]
+  timeout = max(rules.get('command_timeout', _COMMAND_TIMEOUT)
+                for _, rules in entries)
+  for results in common.run_local_all(command_lists, timeout, stream=_log):
+    for result in results:
+      _log_command_result(result)
 
 
 def _run_before_commands(rules):
   _log("Running any before commands specified in the config")
   before_commands = (rules['before_commands'] if 'before_commands' in rules
                      else [])
-  _run_commands(before_commands)
-
-
-def _snapshot_volume(connection, volume_id, description, tags):
-  """Snapshots the volume given by volume_id, with a description."""
-  snapshot = connection.create_snapshot(volume_id, description)
-  if not snapshot:
-    raise Exception("Error taking snapshot for volume {}".format(volume_id))
-
-  # Might want to wait here for the snapshotting to finish
-  # could probably keep checking snapshot.???
-  connection.create_tags([snapshot.id], tags)
-
-  _log("Snapshot taken of volume {}".format(volume_id))
-  return snapshot
+  for command in before_commands:
+    _log("Running custom command {}".format(command))
+    _log_command_result(common.run_local(
+      command, rules.get('command_timeout', _COMMAND_TIMEOUT), stream=_log))
 
 
 def _sort_snapshots_by_datetime(snapshot1, snapshot2):
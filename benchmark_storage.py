@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# This script measures the sequential and random read and write speed of the
+# storage a directory is on, such as a RAID array create_raid.py or
+# create_instance.py just built. It only uses the standard library and runs
+# on the Python 2.6 that comes with older Amazon Linux AMIs, so it can be
+# copied to an instance and run there as is. Reads and writes bypass the
+# page cache with O_DIRECT where the file system supports it. The results
+# are printed as a line of JSON.
+#
+# NO WARRANTY
+#
+# THE PROGRAM IS DISTRIBUTED IN THE HOPE THAT IT WILL BE USEFUL, BUT WITHOUT ANY WARRANTY. IT IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS WITH YOU. SHOULD THE PROGRAM PROVE DEFECTIVE, YOU ASSUME THE COST OF ALL NECESSARY SERVICING, REPAIR OR CORRECTION.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW THE AUTHOR WILL BE LIABLE TO YOU FOR DAMAGES, INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING OUT OF THE USE OR INABILITY TO USE THE PROGRAM (INCLUDING BUT NOT LIMITED TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER PROGRAMS), EVEN IF THE AUTHOR HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+
+from __future__ import print_function
+
+# Standard Modules
+import io
+import json
+import mmap
+import optparse  # argparse isn't in Python 2.6
+import os
+import random
+import threading
+import time
+
+_DROP_CACHES_PATH = "/proc/sys/vm/drop_caches"
+_MEBIBYTE = 1024 * 1024
+_RANDOM_BLOCK_SIZE = 4096
+_SEQUENTIAL_BLOCK_SIZE = _MEBIBYTE
+_TEST_FILE_NAME = ".grab-bag-benchmark"
+
+
+def main():
+  parser = optparse.OptionParser(
+    usage="%prog [options] DIRECTORY",
+    description="Measures the storage DIRECTORY is on and prints the results "
+                "as JSON.")
+  parser.add_option("--size", type="int", default=1024,
+                    help="size in MiB of the test file, capped at half the "
+                         "free space (default %default)")
+  parser.add_option("--seconds", type="int", default=10,
+                    help="how long each random test runs (default %default)")
+  parser.add_option("--threads", type="int", default=8,
+                    help="number of requests in flight during the random "
+                         "tests (default %default)")
+  options, arguments = parser.parse_args()
+  if len(arguments) != 1:
+    parser.error("expected one directory")
+
+  directory = arguments[0]
+  path = os.path.join(directory, _TEST_FILE_NAME)
+  statvfs = os.statvfs(directory)
+  free_size = statvfs.f_bavail * statvfs.f_frsize
+  size = min(options.size * _MEBIBYTE, free_size // 2)
+  size -= size % _SEQUENTIAL_BLOCK_SIZE
+  if size <= 0:
+    parser.error("not enough free space in {0}".format(directory))
+
+  try:
+    direct = _supports_direct(path)
+    results = {
+      'direct': direct,
+      'file_size_mb': size // _MEBIBYTE,
+      'random_block_size': _RANDOM_BLOCK_SIZE,
+      'random_seconds': options.seconds,
+      'random_threads': options.threads,
+      'sequential_block_size': _SEQUENTIAL_BLOCK_SIZE,
+      'sequential_write_mb_per_second': _sequential_write(path, size, direct),
+      'sequential_read_mb_per_second': _sequential_read(path, size, direct),
+      'random_read_iops': _random_io(path, size, options.seconds,
+                                     options.threads, direct, False),
+      'random_write_iops': _random_io(path, size, options.seconds,
+                                      options.threads, direct, True)
+    }
+  finally:
+    if os.path.exists(path):
+      os.remove(path)
+
+  print(json.dumps(results, sort_keys=True))
+
+
+def _create_buffer(size):
+  """Returns a page aligned buffer of size random bytes, as O_DIRECT needs
+  aligned memory."""
+  buffer = mmap.mmap(-1, size)
+  buffer.write(os.urandom(size))
+
+  return buffer
+
+
+def _drop_caches(direct):
+  """Empties the page cache so reads come from the storage, unless direct
+  I/O already bypasses it. Needs root, and is skipped without it."""
+  if direct:
+    return
+
+  try:
+    with open(_DROP_CACHES_PATH, "w") as drop_caches_file:
+      drop_caches_file.write("3\n")
+  except IOError:
+    pass
+
+
+def _open(path, flags, direct):
+  """Opens path with flags, adding O_DIRECT if direct is True, and returns an
+  unbuffered file."""
+  if direct:
+    flags |= os.O_DIRECT
+
+  mode = "w" if flags & os.O_WRONLY else "r"
+  return io.FileIO(os.open(path, flags, 0o600), mode)
+
+
+def _random_io(path, size, seconds, threads, direct, write):
+  """Reads or writes random blocks of the file at path from threads threads
+  for seconds seconds. Returns the number of blocks per second."""
+  block_count = size // _RANDOM_BLOCK_SIZE
+  counts = []
+  _drop_caches(direct)
+
+  def work():
+    buffer = _create_buffer(_RANDOM_BLOCK_SIZE)
+    test_file = _open(path, os.O_WRONLY if write else os.O_RDONLY, direct)
+    count = 0
+
+    try:
+      while time.time() < deadline:
+        test_file.seek(random.randrange(block_count) * _RANDOM_BLOCK_SIZE)
+        if write:
+          test_file.write(buffer)
+        else:
+          test_file.readinto(buffer)
+        count += 1
+
+      if write:
+        os.fsync(test_file.fileno())
+    finally:
+      test_file.close()
+
+    counts.append(count)
+
+  workers = [threading.Thread(target=work) for _ in range(threads)]
+  start = time.time()
+  deadline = start + seconds
+
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+
+  return round(sum(counts) / (time.time() - start), 1)
+
+
+def _sequential_read(path, size, direct):
+  """Reads the file at path from start to end. Returns MiB per second."""
+  buffer = _create_buffer(_SEQUENTIAL_BLOCK_SIZE)
+  _drop_caches(direct)
+  test_file = _open(path, os.O_RDONLY, direct)
+  start = time.time()
+
+  try:
+    while test_file.readinto(buffer):
+      pass
+  finally:
+    test_file.close()
+
+  return round(float(size) / _MEBIBYTE / (time.time() - start), 1)
+
+
+def _sequential_write(path, size, direct):
+  """Writes size bytes to the file at path and syncs it. Returns MiB per
+  second."""
+  buffer = _create_buffer(_SEQUENTIAL_BLOCK_SIZE)
+  test_file = _open(path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, direct)
+  start = time.time()
+
+  try:
+    for _ in range(size // _SEQUENTIAL_BLOCK_SIZE):
+      test_file.write(buffer)
+    os.fsync(test_file.fileno())
+  finally:
+    test_file.close()
+
+  return round(float(size) / _MEBIBYTE / (time.time() - start), 1)
+
+
+def _supports_direct(path):
+  """Returns whether path can be opened with O_DIRECT, which isn't defined
+  on every platform and which some file systems, such as tmpfs, reject."""
+  if not hasattr(os, "O_DIRECT"):
+    return False
+
+  try:
+    os.close(os.open(path, os.O_CREAT | os.O_WRONLY | os.O_DIRECT, 0o600))
+    return True
+  except OSError:
+    return False
+
+
+if __name__ == "__main__":
+  main()
@@ -11,49 +11,330 @@
 from __future__ import print_function
 
 # Standard Modules
+from collections import deque, namedtuple
+from StringIO import StringIO
+from xml.etree import ElementTree
+import argparse
+import datetime
+import json
 import os
+import random
+import re
+import signal
+import socket
+import subprocess
 import sys
+import threading
 import time
 
 # Third-Party Modules
-from boto.ec2.connection import EC2Connection
-from boto.ec2 import elb
-from fabric.api import hide, prompt, run
-import fabric.exceptions
+# boto and fabric are imported by the functions that use them, since they
+# are slow to import and many runs, such as backup.py's, need only part or
+# none of them.
 
 # AWS Credentials
 from credentials import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
 
+_BACKOFF_INITIAL_DELAY = 0.5  # seconds
+_BACKOFF_MAX_DELAY = 10  # seconds
+_BENCHMARK_DIRECTORY_PATH = os.path.expanduser("~/.grab-bag/benchmarks")
+_BENCHMARK_SCRIPT_PATH = os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), "benchmark_storage.py")
+_BENCHMARK_TAG_PREFIX = "Benchmark:"
 _DEFAULT_KEY = "YOUR_PEM_FILE_NAME.pem"  # *REPLACE* with your pem file.
+_DEFAULT_RAID_PROFILE = "streaming"
 _DEFAULT_REGION = "us-east-1"
 _DEFAULT_SECURITY_GROUP = "default"
 _DEFAULT_ZONE = "us-east-1c"
+_DEFAULT_WAIT_TIMEOUT = 600  # seconds
+_DEVICE_MARKER = "__GRAB_BAG_DEVICE__"
+_EC2_API_VERSION = "2016-11-15"
+_INSTANCE_TYPES_PATH = os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), "instance_types.json")
 _KEY_DIRECTORY_PATH = os.path.expanduser("~/.ssh")
-_WAIT_FOR_REMOTE_INTERVAL = 10
+_MAX_TAG_VALUE_LENGTH = 255
+_METADATA_TIMEOUT = 10  # seconds
+_OUTPUT_LIMIT = 65536  # bytes
+_PROBE_TIMEOUT = 3  # seconds
+_SSH_PORT = 22
+_STEP_MARKER = "__GRAB_BAG_STEP__"
+_XFS_MAX_LOG_STRIPE_UNIT = 256  # KiB
+
+LocalResult = namedtuple("LocalResult", [
+  "command",
+  "status",  # negative if killed by a signal, such as after a timeout
+  "output",
+  "seconds",
+  "timed_out"
+])
+
+
+class WaitTimeout(Exception):
+  """Raised by wait_for when what it waits for doesn't happen in time."""
+
+
+_RaidProfile = namedtuple("_RaidProfile", [
+  "chunk_size",  # KiB
+  "read_ahead",  # 512-byte sectors
+  "log_options",
+  "mount_options",
+  "schedulers"  # in order of preference, the multi-queue name first
+])
+
+# Tuning for the workload a RAID array is built for. streaming suits large
+# sequential reads and writes, oltp small random ones, and log small
+# appends that are synced often.
+_RAID_PROFILES = {
+  'log': _RaidProfile(64, 1024, "size=64m,lazy-count=1",
+                      "defaults,noatime,logbufs=8,logbsize=256k",
+                      ["mq-deadline", "deadline"]),
+  'oltp': _RaidProfile(64, 256, "lazy-count=1", "defaults,noatime,inode64",
+                       ["none", "noop"]),
+  'streaming': _RaidProfile(256, 65536, "lazy-count=1",
+                            "defaults,noatime,inode64,largeio,swalloc",
+                            ["mq-deadline", "deadline"])
+}
+
+# Seconds spent in wait_for, keyed by what was waited for.
+_wait_times = {}
+
+
+def append_line_command(line, path):
+  """Returns a shell command that appends line to the file at path unless
+  the file already has it, so running it again is harmless."""
+  return "grep -qxF '{0}' {1} || echo '{0}' >> {1}".format(line, path)
+
+
+def attach_volumes(connection, instance_id, volume_ids, device_paths,
+                   timeout=_DEFAULT_WAIT_TIMEOUT):
+  """Waits for every volume in volume_ids to be available, then attaches
+  them together to instance_id at the matching paths in device_paths.
+  Returns the device paths the volumes showed up at on the remote host
+  (Fabric environment settings), in the same order. These can differ from
+  device_paths, such as /dev/xvdf1 or /dev/nvme1n1 for /dev/sdf1."""
+  wait_for_volumes(connection, volume_ids, "available", timeout)
+
+  for volume_id, device_path in zip(volume_ids, device_paths):
+    print("Attaching {} to {}".format(volume_id, device_path))
+    connection.attach_volume(volume_id, instance_id, device_path)
+
+  devices = wait_for_devices(dict(zip(volume_ids, device_paths)), timeout)
+
+  return [devices[volume_id][0] for volume_id in volume_ids]
+
+
+def backoff_delays(initial=_BACKOFF_INITIAL_DELAY, maximum=_BACKOFF_MAX_DELAY):
+  """Yields delays that double from initial up to maximum. Each delay is
+  jittered down by up to half, so many waiters don't poll in lockstep."""
+  delay = initial
+
+  while True:
+    yield delay / 2 + random.uniform(0, delay / 2)
+    delay = min(delay * 2, maximum)
+
+
+def benchmark_directory(directory, size_mb=1024, seconds=10, threads=8):
+  """Copies benchmark_storage.py to the remote host (Fabric environment
+  settings), runs it against the storage directory is on and returns its
+  results as a dict."""
+  from fabric.api import hide, put, sudo
+  print("Benchmarking {}".format(directory))
+  remote_path = os.path.basename(_BENCHMARK_SCRIPT_PATH)
+  put(_BENCHMARK_SCRIPT_PATH, remote_path)
+
+  with hide("stdout"):
+    output = sudo("python {0} --size {1} --seconds {2} --threads {3} {4}; "
+                  "status=$?; rm -f {0}; exit $status".format(
+                    remote_path, size_mb, seconds, threads, directory))
+
+  results = json.loads(output.splitlines()[-1])
+  for key, value in sorted(results.iteritems()):
+    print("{:>32} {}".format(key, value))
+
+  return results
+
+
+def call_ec2_api(connection, action, params):
+  """Calls action with params over connection using a newer EC2 API version
+  than boto's, for calls and parameters boto predates, such as
+  DescribeInstanceTypes or gp3 volumes. Returns the response as an
+  ElementTree element, with the XML namespace taken out of the tags. Raises
+  EC2ResponseError if the call fails."""
+  from boto.exception import EC2ResponseError
+  api_version = connection.APIVersion
+  connection.APIVersion = _EC2_API_VERSION
+
+  try:
+    response = connection.make_request(action, params)
+    body = response.read()
+  finally:
+    connection.APIVersion = api_version
+
+  if response.status != 200:
+    raise EC2ResponseError(response.status, response.reason, body)
+
+  root = ElementTree.fromstring(body)
+  for element in root.iter():
+    element.tag = element.tag.split("}")[-1]
+
+  return root
 
 
 def connect(region=None):
   """Connects to EC2 and returns an EC2Connection."""
+  from boto.ec2.connection import EC2Connection
   return EC2Connection(aws_access_key_id=AWS_ACCESS_KEY_ID,
                        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
                        region=region)
 
 
+def connect_region(region_name=_DEFAULT_REGION):
+  """Connects to EC2 in the region named region_name, without prompting, and
+  returns an EC2Connection."""
+  from boto import ec2
+  return ec2.connect_to_region(region_name,
+                               aws_access_key_id=AWS_ACCESS_KEY_ID,
+                               aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+
+
 def connect_elb_region(region_name=_DEFAULT_REGION):
   """Connects to the ELB service for region_name and returns the ELB
   connection."""
-  print ("Connecting to ELB service for region {}".format(region_name))
+  from boto.ec2 import elb
+  print("Connecting to ELB service for region {}".format(region_name),
+        file=sys.stderr)
   return elb.connect_to_region(region_name,
                                aws_access_key_id=AWS_ACCESS_KEY_ID,
                                aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
 
 
+def get_data_disk_count(level, member_count):
+  """Returns how many of the member_count devices in a RAID array of level
+  hold a stripe's data, or None for levels that don't stripe."""
+  if level == "0":
+    return member_count
+  elif level == "10":
+    return member_count // 2
+  elif level in ("4", "5"):
+    return member_count - 1
+  elif level == "6":
+    return member_count - 2
+
+  return None
+
+
+def get_default_raid_profile():
+  """Returns the name of the RAID tuning profile used unless another is
+  chosen."""
+  return _DEFAULT_RAID_PROFILE
+
+
+def get_instance_types_path():
+  """Returns the path of instance_types.json, the catalog of instance types
+  create_instance.py builds and create_raid.py plans within."""
+  return _INSTANCE_TYPES_PATH
+
+
+def get_raid_commands(devices, member_count, level, raid_device_path,
+                      raid_directory_path,
+                      profile_name=_DEFAULT_RAID_PROFILE):
+  """Returns the commands that build a RAID array at raid_device_path out of
+  member_count devices, tune it and its members for the profile named
+  profile_name, then format it with XFS and mount it at raid_directory_path.
+  devices is the member device paths separated by spaces, or a shell
+  expression that expands to them. For level 0, where every member holds
+  data, member_count may also be a shell expression that expands to the
+  count. The file system is aligned to the chunk
+  size and the number of data disks for level. The commands are safe to run
+  again after a partial failure."""
+  profile = _RAID_PROFILES[profile_name]
+  data_disk_count = get_data_disk_count(level, member_count)
+  mdadm_parameters = ["--create {}".format(raid_device_path)]
+  mkfs_parameters = ["-f"]
+  log_options = ["version=2"]
+
+  if data_disk_count:
+    mdadm_parameters.append("--chunk={}".format(profile.chunk_size))
+    mkfs_parameters.append("-d su={}k,sw={}".format(profile.chunk_size,
+                                                    data_disk_count))
+    log_options.append("su={}k".format(min(profile.chunk_size,
+                                           _XFS_MAX_LOG_STRIPE_UNIT)))
+
+  log_options.append(profile.log_options)
+  mkfs_parameters.extend(["-l {}".format(",".join(log_options)),
+                          raid_device_path])
+  mdadm_parameters.extend([
+    "--level={}".format(level),
+    "--raid-devices={}".format(member_count),
+    devices
+  ])
+
+  fstab_line_parts = [
+    raid_device_path,
+    raid_directory_path,
+    "xfs",
+    profile.mount_options,
+    "0",
+    "0"
+  ]
+
+  # Scheduler names differ between the multi-queue and legacy block layers,
+  # so the first one the kernel accepts wins.
+  scheduler_command = (
+    "for device in {}; do for scheduler in {}; do echo $scheduler > "
+    "/sys/block/$(basename $(readlink -f $device))/queue/scheduler "
+    "2> /dev/null && break; done; done; true".format(
+      devices, " ".join(profile.schedulers)))
+  read_ahead_command = "/sbin/blockdev --setra {} {}".format(
+    profile.read_ahead, raid_device_path)
+
+  return [
+    "mdadm --detail {} > /dev/null 2>&1 || yes | mdadm {}".format(
+      raid_device_path, " ".join(mdadm_parameters)),
+    "line=\"DEVICE $(echo {})\"; grep -qxF \"$line\" /etc/mdadm.conf || "
+    "echo \"$line\" >> /etc/mdadm.conf".format(devices),
+    "grep -q '^ARRAY {0} ' /etc/mdadm.conf || mdadm --detail --scan | "
+    "grep '^ARRAY {0} ' >> /etc/mdadm.conf".format(raid_device_path),
+    scheduler_command,
+    read_ahead_command,
+    "blkid {} > /dev/null || mkfs.xfs {}".format(raid_device_path,
+                                                 " ".join(mkfs_parameters)),
+    "mkdir -p {}".format(raid_directory_path),
+    append_line_command(" ".join(fstab_line_parts), "/etc/fstab"),
+    "mountpoint -q {} || mount {}".format(raid_directory_path,
+                                          raid_device_path),
+    "chown ec2-user:ec2-user {}".format(raid_directory_path),
+    # Manually assembles RAID array.  This should be done automatically at
+    # boot, but that doesn't seem to happen.
+    append_line_command("/sbin/mdadm -A {}".format(raid_device_path),
+                        "/etc/rc.local"),
+    append_line_command("/bin/mount {}".format(raid_device_path),
+                        "/etc/rc.local"),
+    # Ensures the tuning is applied on every start up.
+    append_line_command(read_ahead_command, "/etc/rc.local"),
+    append_line_command(scheduler_command, "/etc/rc.local")
+  ]
+
+
+def get_raid_profile_names():
+  """Returns the names of the RAID tuning profiles, sorted."""
+  return sorted(_RAID_PROFILES)
+
+
 def get_self_instance_id():
   """Returns the instance id of the instance this is running on."""
   # See also:
   # http://stackoverflow.com/questions/625644
   # http://docs.amazonwebservices.com/AWSEC2/latest/UserGuide/AESDG-chapter-instancedata.html pylint: disable=C0301
-  return run_command("wget -q -O - http://169.254.169.254/latest/meta-data/instance-id")
+  url = "http://169.254.169.254/latest/meta-data/instance-id"
+  result = run_local(["wget", "-q", "-O", "-", url], _METADATA_TIMEOUT)
+  instance_id = result.output.strip()
+  if result.status or result.timed_out or not instance_id:
+    raise Exception("Could not read the instance id from {} ({})".format(
+      url, "timed out" if result.timed_out else
+      "exit status {}".format(result.status)))
+
+  return instance_id
 
 
 def get_self_instance(connection):
@@ -65,6 +346,30 @@ def get_self_instance(connection):
   return reservations[0].instances[0]
 
 
+def get_used_device_paths(instance):
+  """Returns the device paths in use on instance, the remote host (Fabric
+  environment settings), from /sys/block and its block device mapping.
+  Devices Xen renamed from /dev/sdX to /dev/xvdX are listed under both
+  names."""
+  from fabric.api import hide, run
+  with hide("running", "stdout"):
+    names = run("ls /sys/block").split()
+
+  device_paths = []
+  for name in names:
+    device_paths.append("/dev/{}".format(name))
+    if name.startswith("xvd"):
+      device_paths.append("/dev/sd{}".format(name[len("xvd"):]))
+
+  return device_paths + list(instance.block_device_mapping or {})
+
+
+def get_wait_times():
+  """Returns a dict of how many seconds have been spent in wait_for, keyed
+  by what was waited for."""
+  return dict(_wait_times)
+
+
 def get_pem(instance):
   """Returns the .pem file needed to communicate with a given instance. This
   does not guarantee that the .pem file exists."""
@@ -75,6 +380,7 @@ def prompt_choice(question, choices, default=None):
   """Prompts the user for a choice amongst choices.  default is the default
   index of the choices that will be used if the user doesn't type anything in.
   The question parameter is prompted to the user."""
+  from fabric.api import prompt
   keys = sorted(choices)
   values = keys
 
@@ -128,6 +434,25 @@ def prompt_confirmation(confirmation, default_choice=False):
     # If it is neither a y, n, or blank, prompt again!
 
 
+def prompt_device_prefix(used_devices):
+  """Prompts for the device path new volumes are attached at with numbers
+  appended, such as /dev/sdf for /dev/sdf1 and /dev/sdf2, offering the ones
+  none of used_devices starts with."""
+  possible_device_paths = ["/dev/sd" + chr(letter)
+    for letter in range(ord("f"), ord("z") + 1)]
+
+  # Remove used device paths from the list
+  for used_device in used_devices:
+    used_device_no_trailing_digits = re.sub("\\d+$", "", used_device)
+    if used_device_no_trailing_digits in possible_device_paths:
+      possible_device_paths.remove(used_device_no_trailing_digits)
+
+  # Offer the user a prompt of which device path to beginning with
+  return prompt_choice(
+    "Volumes should be attached with numbers appended to which device path",
+    possible_device_paths[:9], 1)
+
+
 def prompt_elb(elb_connection, default_elb_name):
   """Prompts the user to choose an elastic load balancer."""
   elbs = [(some_elb.name, some_elb) for some_elb
@@ -145,9 +470,9 @@ def prompt_instance(connection, description):
   names = []
   instances = []
   for reservation in connection.get_all_instances():
-    instance = reservation.instances[0]
-    instances.append(instance)
-    names.append(instance.tags.get("Name"))
+    for instance in reservation.instances:
+      instances.append(instance)
+      names.append(instance.tags.get("Name"))
   chosen_name = prompt_choice(description, names)
   return instances[names.index(chosen_name)]
 
@@ -183,40 +508,430 @@ def prompt_zone(connection, default_zone=_DEFAULT_ZONE):
   return prompt_choice("Zone", zones, default_zone)
 
 
-def run_command(command):
-  """Shim for running commands on the local operating system.
-  This allows us to use either subprocess.check_output
-  (Python 2.7+) or commands (before 2.7)."""
+def parse_device_output(output):
+  """Picks the device marker lines printed by a script from
+  render_device_watch_script out of its output. Returns a dict of volume id
+  to (device path, seconds until it arrived)."""
+  devices = {}
+
+  for line in output.splitlines():
+    parts = line.split()
+    if len(parts) == 4 and parts[0] == _DEVICE_MARKER:
+      devices[parts[1]] = (parts[2], int(parts[3]) / 1000.0)
+
+  return devices
+
+
+def parse_step_output(commands, output):
+  """Picks the step marker lines printed by a script from
+  render_steps_script out of its output. Returns a list of (command,
+  exit status, seconds) tuples for the commands that ran."""
+  results = []
+
+  for line in output.splitlines():
+    parts = line.split()
+    if len(parts) == 4 and parts[0] == _STEP_MARKER:
+      index, status, milliseconds = [int(part) for part in parts[1:]]
+      results.append((commands[index], status, milliseconds / 1000.0))
+
+  return results
+
+
+def positive_int(value):
+  """Parses value as an argparse argument that must be a positive integer."""
   try:
-    import commands
-    return commands.getoutput(command)
-  except ImportError:
+    number = int(value)
+  except ValueError:
+    number = 0
+
+  if number < 1:
+    raise argparse.ArgumentTypeError(
+      "{} is not a positive integer".format(value))
+
+  return number
+
+
+def record_benchmark(connection, instance_id, directory, results, details):
+  """Records results from benchmark_directory for the storage at directory
+  on instance_id, along with details of how it was built, such as the
+  instance type and RAID profile. The record is written as JSON under
+  ~/.grab-bag/benchmarks, and a summary is tagged on the instance so builds
+  can be compared from the console. Returns the path of the JSON file."""
+  benchmarked_at = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+  record = dict(details, benchmarked_at=benchmarked_at, directory=directory,
+                instance_id=instance_id, results=results)
+
+  if not os.path.isdir(_BENCHMARK_DIRECTORY_PATH):
+    os.makedirs(_BENCHMARK_DIRECTORY_PATH)
+
+  path = os.path.join(_BENCHMARK_DIRECTORY_PATH, "{}-{}.json".format(
+    instance_id, benchmarked_at))
+  with open(path, "w") as benchmark_file:
+    json.dump(record, benchmark_file, indent=2, separators=(",", ": "),
+              sort_keys=True)
+    benchmark_file.write("\n")
+
+  summary = " ".join(["seq_write={}MB/s".format(
+                        results["sequential_write_mb_per_second"]),
+                      "seq_read={}MB/s".format(
+                        results["sequential_read_mb_per_second"]),
+                      "rand_read={}iops".format(results["random_read_iops"]),
+                      "rand_write={}iops".format(
+                        results["random_write_iops"])] +
+                     ["{}={}".format(key, value)
+                      for key, value in sorted(details.iteritems())])
+  connection.create_tags([instance_id], {
+    _BENCHMARK_TAG_PREFIX + directory: summary[:_MAX_TAG_VALUE_LENGTH]
+  })
+  print("Recorded benchmark in {}".format(path))
+
+  return path
+
+
+def render_device_watch_script(volume_devices, timeout=_DEFAULT_WAIT_TIMEOUT):
+  """Renders a bash script that waits for the EBS volumes in volume_devices,
+  a dict of volume id to the device path it was attached at, to show up as
+  block devices. NVMe volumes are matched by the volume id in their serial
+  number, others by the attach path or its /dev/xvdX rename. After each
+  udevadm settle it checks what is still missing, then waits for something
+  new in /dev with inotifywait, or a second if that isn't installed. A
+  device marker line is printed as each device arrives, and the script
+  exits non-zero if any are still missing after timeout seconds."""
+  pending = " ".join("{}={}".format(volume_id, device_path)
+                     for volume_id, device_path
+                     in sorted(volume_devices.iteritems()))
+
+  return "\n".join([
+    "#!/bin/bash",
+    "start=$(date +%s%N)",
+    "deadline=$(( $(date +%s) + {} ))".format(int(timeout)),
+    "pending=\"{}\"".format(pending),
+    "find_device() {",
+    "  serial=${1/-/}",
+    "  for block in /sys/block/nvme*n1; do",
+    "    if [ \"$(cat $block/device/serial 2> /dev/null | tr -d ' ')\" = "
+    "\"$serial\" ]; then",
+    "      echo /dev/${block##*/}",
+    "      return",
+    "    fi",
+    "  done",
+    "  for path in $2 /dev/xvd${2#/dev/sd}; do",
+    "    [ -b $path ] && echo $path && return",
+    "  done",
+    "}",
+    "while true; do",
+    "  udevadm settle --timeout=5 2> /dev/null",
+    "  missing=",
+    "  for pair in $pending; do",
+    "    device=$(find_device ${pair%%=*} ${pair#*=})",
+    "    if [ -n \"$device\" ]; then",
+    "      echo \"{} ${{pair%%=*}} $device "
+    "$(( ($(date +%s%N) - start) / 1000000 ))\"".format(_DEVICE_MARKER),
+    "    else",
+    "      missing=\"$missing $pair\"",
+    "    fi",
+    "  done",
+    "  pending=$missing",
+    "  [ -z \"$pending\" ] && exit 0",
+    "  [ $(date +%s) -ge $deadline ] && exit 1",
+    "  if command -v inotifywait > /dev/null; then",
+    "    inotifywait -qq -t 1 -e create /dev",
+    "  else",
+    "    sleep 1",
+    "  fi",
+    "done"
+  ]) + "\n"
+
+
+def render_steps_script(phase, commands):
+  """Renders commands into a single bash script for phase. The commands run
+  in order, each in its own subshell. After each one the script prints a
+  newline, in case the command's output didn't end with one, and a step
+  marker line with the command's index, exit status and run time in
+  milliseconds, and it stops at the first command that fails."""
+  lines = [
+    "#!/bin/bash",
+    "# {}".format(phase)
+  ]
+
+  for index, command in enumerate(commands):
+    lines.extend([
+      "start=$(date +%s%N)",
+      "(",
+      command,
+      ")",
+      "status=$?",
+      "echo",
+      "echo \"{} {} $status $(( ($(date +%s%N) - start) / 1000000 ))\"".format(
+        _STEP_MARKER, index),
+      "[ $status -eq 0 ] || exit $status"
+    ])
+
+  return "\n".join(lines) + "\n"
+
+
+def run_local(command, timeout=None, output_limit=_OUTPUT_LIMIT,
+              stream=None):
+  """Runs command on the local host, through the shell if it's a string or
+  without one if it's a list of arguments, with stderr merged into stdout.
+  The command and everything it started are killed after timeout seconds.
+  Each line of output is passed to stream as it arrives, if given, and only
+  the last output_limit bytes are kept. Returns a LocalResult."""
+  start = time.time()
+  with open(os.devnull) as devnull:
+    process = subprocess.Popen(command, shell=isinstance(command, basestring),
+                               stdin=devnull, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, close_fds=True,
+                               preexec_fn=os.setsid)
+  timed_out = []
+
+  def kill():
+    timed_out.append(True)
     try:
-      # check_output was only used in Python 2.7+.
-      from subprocess import check_output as subprocess_check_output
-      command_arguments = command.split(" ")
-      return str(subprocess_check_output(command_arguments))
-    except ImportError:
-      raise ImportError(
-        "Neither modules 'commands' nor 'subprocess' were found.")
+      os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+      pass
 
+  timer = threading.Timer(timeout, kill) if timeout else None
+  if timer:
+    timer.daemon = True
+    timer.start()
 
-def wait_until_remote_reachable():
-  """Waits until the remote host (Fabric environment settings) is reachable."""
-  print("Ensuring remote host is reachable")
+  lines = deque()
+  size = 0
+  try:
+    for line in iter(process.stdout.readline, ""):
+      if stream:
+        stream(line.rstrip("\n"))
+      lines.append(line)
+      size += len(line)
+      while size > output_limit and len(lines) > 1:
+        size -= len(lines.popleft())
+
+    process.wait()
+  finally:
+    if timer:
+      timer.cancel()
+
+  return LocalResult(command, process.returncode,
+                     "".join(lines)[-output_limit:].rstrip("\n"),
+                     time.time() - start, bool(timed_out))
+
+
+def run_local_all(command_lists, timeout=None, output_limit=_OUTPUT_LIMIT,
+                  stream=None):
+  """Runs each list of commands in command_lists on the local host, the
+  commands in a list one after another and the lists at the same time. Each
+  command is run as run_local runs it. Returns a list of LocalResults for
+  each list, in the same order."""
+  results = [[] for _ in command_lists]
+  errors = []
+
+  def work(index):
+    try:
+      for command in command_lists[index]:
+        results[index].append(run_local(command, timeout, output_limit,
+                                        stream))
+    except Exception as err:  # pylint: disable=W0703
+      errors.append(err)
+
+  threads = [threading.Thread(target=work, args=(index,))
+             for index in range(len(command_lists))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  if errors:
+    raise errors[0]
+
+  return results
+
+
+def run_script_locally(phase, script):
+  """Runs script with the local bash and returns its output. This is a
+  stand-in for the remote host, so step scripts can be checked offline, for
+  example with stub commands first on the PATH."""
+  process = subprocess.Popen(["bash", "-s"], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+  output, _ = process.communicate(script)
+  return output
+
+
+def run_script_remotely(phase, script):
+  """Uploads script to the remote host (Fabric environment settings) and runs
+  it with a single sudo, removing it afterwards. Returns its output."""
+  from fabric.api import put, settings, sudo
+  remote_path = "{}.sh".format(re.sub(r"\W+", "-", phase))
+  put(StringIO(script), remote_path)
+
+  with settings(warn_only=True):
+    return sudo("bash {0}; status=$?; rm -f {0}; exit $status".format(
+      remote_path))
+
+
+def run_steps(phase, commands, runner=run_script_remotely):
+  """Runs commands as one script through runner, instead of one round trip
+  per command, and prints the exit status and time of each. Aborts if any
+  command failed, or if the script stopped before running them all.
+  Returns the (command, exit status, seconds) tuples."""
+  if not commands:
+    return []
+
+  print("Running {} ({} steps)".format(phase, len(commands)))
+  output = runner(phase, render_steps_script(phase, commands))
+  results = parse_step_output(commands, output)
+
+  for command, status, seconds in results:
+    print("{:>8.2f}s {:>3} {}".format(seconds, status, command))
+
+  if results and results[-1][1] != 0:
+    failed_command = results[-1][0]
+  elif len(results) < len(commands):
+    # The script was cut off after the last step that finished.
+    failed_command = commands[len(results)]
+  else:
+    return results
+
+  from fabric.api import abort
+  abort("{} failed at: {}".format(phase, failed_command))
+
+
+def wait_for(check, description, timeout=_DEFAULT_WAIT_TIMEOUT):
+  """Calls check until it returns something truthy and returns that value,
+  sleeping for backoff_delays between attempts. Raises WaitTimeout once
+  timeout seconds have passed. The time spent is added to get_wait_times()
+  under description."""
+  start = time.time()
+  deadline = start + timeout
+  delays = backoff_delays()
   attempt = 0
 
-  while True:
-    try:
+  try:
+    while True:
       attempt += 1
+      result = check()
+      if result:
+        return result
+
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        raise WaitTimeout("Timed out after {} seconds waiting for {}".format(
+          timeout, description))
+
+      delay = min(next(delays), remaining)
+      print("Waiting for {} (attempt={}), sleeping {:.1f} seconds".format(
+        description, attempt, delay))
+      time.sleep(delay)
+  finally:
+    _wait_times[description] = (_wait_times.get(description, 0) +
+                                time.time() - start)
+
+
+def wait_for_devices(volume_devices, timeout=_DEFAULT_WAIT_TIMEOUT,
+                     runner=run_script_remotely):
+  """Waits for the EBS volumes in volume_devices, a dict of volume id to
+  the device path it was attached at, to appear on the host, with a single
+  script run through runner. The host may name a device differently from
+  its attach path, such as /dev/xvdf or /dev/nvme1n1. Aborts if any are
+  still missing after timeout seconds. Returns a dict of volume id to
+  (device path, seconds until it arrived)."""
+  from fabric.api import abort
+  output = runner("wait for devices",
+                  render_device_watch_script(volume_devices, timeout))
+  devices = parse_device_output(output)
+
+  for volume_id, (device_path, seconds) in sorted(devices.iteritems()):
+    print("{:>8.2f}s {} at {}".format(seconds, volume_id, device_path))
+
+  missing = sorted(set(volume_devices) - set(devices))
+  if missing:
+    abort("Timed out after {} seconds waiting for {}".format(
+      timeout, ", ".join(missing)))
+
+  return devices
+
+
+def wait_for_instances(connection, instance_ids,
+                       timeout=_DEFAULT_WAIT_TIMEOUT):
+  """Waits until none of the instances in instance_ids is pending, fetching
+  all of them with one request per attempt. Returns a dict of instance id to
+  the up-to-date instance."""
+  instances = {}
+
+  def check():
+    filters = {"instance-id": list(instance_ids)}
+    for reservation in connection.get_all_instances(filters=filters):
+      for instance in reservation.instances:
+        instances[instance.id] = instance
+
+    return (len(instances) == len(instance_ids) and
+            all(instance.state != "pending"
+                for instance in instances.itervalues()))
+
+  wait_for(check, "instances to start", timeout)
+  return instances
+
+
+def wait_for_volumes(connection, volume_ids, status,
+                     timeout=_DEFAULT_WAIT_TIMEOUT):
+  """Waits until every volume in volume_ids has status, fetching all of them
+  with one request per attempt. Aborts if any of them goes into error.
+  Returns a dict of volume id to the up-to-date volume."""
+  from fabric.api import abort
+  volumes = {}
+
+  def check():
+    filters = {"volume-id": list(volume_ids)}
+    for volume in connection.get_all_volumes(filters=filters):
+      volumes[volume.id] = volume
+
+    failed = [volume.id for volume in volumes.itervalues()
+              if volume.status == "error"]
+    if failed:
+      abort("Volumes failed: {}".format(", ".join(failed)))
+
+    return (len(volumes) == len(volume_ids) and
+            all(volume.status == status for volume in volumes.itervalues()))
+
+  wait_for(check, "volumes to be {}".format(status), timeout)
+  return volumes
+
+
+def wait_until_remote_reachable(timeout=_DEFAULT_WAIT_TIMEOUT):
+  """Waits until the remote host (Fabric environment settings) is reachable.
+  Cheap TCP connects to the SSH port are tried first, and a full SSH login
+  only once the port accepts connections."""
+  from fabric.api import env
+  from fabric.network import normalize
+  print("Ensuring remote host is reachable")
+  _, host, port = normalize(env.host_string)
 
-      with hide("running"):
-        run("echo")
-
-      break
-    except fabric.exceptions.NetworkError:
-      print("Waiting for remote host (attempt={})".format(attempt))
-      print("Sleeping {} seconds".format(_WAIT_FOR_REMOTE_INTERVAL))
-      time.sleep(_WAIT_FOR_REMOTE_INTERVAL)
+  wait_for(lambda: _probe_port(host, int(port or _SSH_PORT)), "remote port",
+           timeout)
+  wait_for(_probe_login, "remote login", timeout)
 
   print("Successfully reached remote host")
+
+
+def _probe_login():
+  """Returns whether a command can be run on the remote host."""
+  from fabric.api import hide, run
+  import fabric.exceptions
+  try:
+    with hide("running"):
+      run("echo")
+
+    return True
+  except fabric.exceptions.NetworkError:
+    return False
+
+
+def _probe_port(host, port):
+  """Returns whether a TCP connection to host:port can be opened."""
+  try:
+    socket.create_connection((host, port), _PROBE_TIMEOUT).close()
+    return True
+  except (socket.error, socket.timeout):
+    return False
@@ -13,6 +13,10 @@ from __future__ import print_function
 
 # Standard Modules
 from collections import namedtuple
+import argparse
+import datetime
+import hashlib
+import json
 import os
 import sys
 import time
@@ -21,7 +25,8 @@ import time
 from boto.ec2.blockdevicemapping import BlockDeviceMapping
 from boto.ec2.blockdevicemapping import BlockDeviceType
 from boto.exception import EC2ResponseError
-from fabric.api import env, prompt, put, reboot, run, sudo
+from fabric.api import (abort, env, execute, hide, prompt, put, reboot, run,
+                        settings, sudo)
 
 # Local Modules
 import common
@@ -34,22 +39,35 @@ _AMI = {
   'us-west-2': "ami-48da5578"  # 64-bit Amazon Linux 2012.03.3 (EBS-Backed)
 }
 
+_BAKE_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+_BAKE_DATETIME_TAG = "Bake-Datetime"
+_BAKE_HASH_TAG = "Bake-Recipe-Hash"
+_CHECKPOINT_DIRECTORY_PATH = os.path.expanduser("~/.grab-bag/checkpoints")
 _DEFAULT_INSTANCE_TYPE = "m1.large"
+_DEFAULT_POOL_SIZE = 5
+_EPHEMERAL_DEVICES_PATH = "/var/lib/grab-bag/ephemeral-devices"
 _GIT_REPO = ""  #  *REPLACE* Replace with your git repo, such as git@github.com:YOURNAME/YOURFILE.git
+_METADATA_URL = "http://169.254.169.254/latest/meta-data"
 _USERNAME = "ec2-user"
-_WAIT_FOR_REMOTE_INTERVAL = 10
-_WAIT_FOR_START_INTERVAL = 3
+_USER_DATA_LOG_PATH = "/var/log/grab-bag-user-data.log"
+_USER_DATA_STATUS_PATH = "/var/lib/grab-bag/user-data-status"
+_USER_DATA_TIMEOUT = 3600  # seconds
+_WAIT_STEP_PREFIX = "waited for "
 
+# http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/InstanceStorage.html
 _InstanceType = namedtuple("_InstanceType", [
   "name",
-  "ephemeral_disk_count"
+  "ephemeral_disk_count",
+  "ephemeral_disk_size"  # GiB per disk
 ])
 
 _LaunchArguments = namedtuple("_LaunchArguments", [
+  "image_id",
   "instance_type",
   "key_name",
-  "name",
+  "names",
   "security_group",
+  "user_data",
   "zone"
 ])
 
@@ -57,23 +75,6 @@ _GEM_PACKAGES = [
   "rake"
 ]
 
-# http://docs.amazonwebservices.com/AWSEC2/latest/UserGuide/instance-types.html
-_INSTANCE_TYPES = [
-  _InstanceType("m1.small", 1),
-  _InstanceType("m1.large", 2),
-  _InstanceType("m1.xlarge", 4),
-  _InstanceType("t1.micro", 0),
-  _InstanceType("c1.medium", 1),
-  _InstanceType("c1.xlarge", 4),
-  _InstanceType("m2.xlarge", 1),
-  _InstanceType("m2.2xlarge", 1),
-  _InstanceType("m2.4xlarge", 2),
-  _InstanceType("hi1.4xlarge", 2),
-  _InstanceType("cc1.4xlarge", 2),
-  _InstanceType("cc2.8xlarge", 4),
-  _InstanceType("cg1.4xlarge", 2)
-]
-
 _YUM_PACKAGES = [
   "bzip2-devel",
   "gcc-c++",
@@ -96,38 +97,156 @@ _YUM_PACKAGES = [
 
 
 def main():
+  parser = argparse.ArgumentParser(
+    description="Creates and provisions new EC2 instances.")
+  parser.add_argument("--count", type=common.positive_int, default=1,
+                      help="number of instances to launch (default "
+                           "%(default)s)")
+  parser.add_argument("--parallel", type=common.positive_int,
+                      default=_DEFAULT_POOL_SIZE,
+                      help="number of instances provisioned at once "
+                           "(default %(default)s)")
+  parser.add_argument("--benchmark", action="store_true",
+                      help="measures the ephemeral RAID array once it is "
+                           "built and records the results")
+  parser.add_argument("--bake", action="store_true",
+                      help="launches from an AMI already baked with the "
+                           "current packages and system files if there is "
+                           "one, or bakes one after provisioning if not")
+  parser.add_argument("--keep-bakes", type=int, default=0,
+                      help="with --bake, deregisters all but this many of "
+                           "the newest baked AMIs (default 0 keeps all)")
+  parser.add_argument("--user-data", action="store_true",
+                      help="runs the system file, package and ephemeral "
+                           "RAID setup from cloud-init while the instance "
+                           "boots instead of over SSH")
+  parser.add_argument("--raid-profile",
+                      default=common.get_default_raid_profile(),
+                      choices=common.get_raid_profile_names(),
+                      help="how the ephemeral RAID is tuned (default "
+                           "%(default)s)")
+  parser.add_argument("--refresh-instance-types", action="store_true",
+                      help="rebuilds {} from the instance types EC2 "
+                           "offers in the chosen region, then exits".format(
+                             common.get_instance_types_path()))
+  parser.add_argument("--resume", nargs="+", metavar="INSTANCE_ID",
+                      help="carries on provisioning instances an earlier "
+                           "run didn't finish, skipping the steps their "
+                           "checkpoints say are done")
+  options = parser.parse_args()
+  if options.bake and options.user_data:
+    parser.error("--bake can't be combined with --user-data")
+  if options.resume and (options.bake or options.user_data):
+    parser.error("--resume can't be combined with --bake or --user-data")
+
+  if options.resume:
+    connection, instances = _find_checkpointed_instances(options.resume)
+    _provision_instances(connection, instances, options.parallel)
+    return
+
   connection = common.connect()
   region = common.prompt_region(connection)
   connection = common.connect(region)
+
+  if options.refresh_instance_types:
+    _refresh_instance_types(connection)
+    return
+
   zone = common.prompt_zone(connection)
   security_group = common.prompt_security_group(connection)
   prefix = "{}-{}-".format(security_group, zone.split("-")[-1])
-  name = _prompt_name(connection, prefix)
+  names = _prompt_names(connection, prefix, options.count)
   instance_type = _prompt_instance_type()
   key_path = common.prompt_key_path()
   key_name = os.path.basename(key_path).split(".")[0]
 
-  arguments = _LaunchArguments(instance_type=instance_type,
+  recipe_hash = _get_recipe_hash(region) if options.bake else None
+  baked_image = (_find_baked_image(connection, recipe_hash) if options.bake
+                 else None)
+  if baked_image:
+    print("Using baked image {} for recipe {}".format(baked_image.id,
+                                                      recipe_hash))
+
+  user_data_commands = (_get_user_data_commands(instance_type,
+                                                options.raid_profile)
+                        if options.user_data else None)
+
+  arguments = _LaunchArguments(image_id=(baked_image.id if baked_image
+                                         else _AMI[region.name]),
+                               instance_type=instance_type,
                                key_name=key_name,
-                               name=name,
+                               names=names,
                                security_group=security_group,
+                               user_data=(_render_user_data(user_data_commands)
+                                          if options.user_data else None),
                                zone=zone)
 
-  env.host_string = _launch(connection, arguments, region)
-  env.key_filename = key_path
-  env.user = _USERNAME
-  common.wait_until_remote_reachable()
-  sudo("hostname {}".format(name))
-  _update_system_files(name)
-  _install()
-  _update_installed_files()
-  reboot()
-
-  if instance_type.ephemeral_disk_count > 1:
-    _create_ephemeral_raid(instance_type.ephemeral_disk_count)
-  
-  if _GIT_REPO:
-    _clone()
+  instances = _launch(connection, arguments)
+
+  for instance, name in zip(instances, names):
+    checkpoint = {
+      'benchmark': options.benchmark,
+      'completed': [],
+      'instance_id': instance.id,
+      'instance_type': instance_type.name,
+      'key_path': key_path,
+      'name': name,
+      'raid_profile': options.raid_profile,
+      'region': region.name,
+      'user_data': options.user_data
+    }
+    if baked_image:
+      checkpoint['completed'] = [step for step, _, _ in
+                                 _get_base_steps(checkpoint)]
+    _save_checkpoint(checkpoint)
+
+  _provision_instances(connection, instances, options.parallel,
+                       recipe_hash if options.bake and not baked_image
+                       else None, options.keep_bakes)
+
+
+def _bake_image(connection, instance_id, recipe_hash, keep_bakes):
+  """Creates an AMI from instance_id, which has just been through
+  _provision_base, and tags it with recipe_hash so that later runs with the
+  same recipe can launch from it. If keep_bakes is set, all but the newest
+  keep_bakes baked AMIs are deregistered."""
+  baked_at = datetime.datetime.utcnow().strftime(_BAKE_DATETIME_FORMAT)
+  name = "grab-bag-{}-{}".format(recipe_hash[:12],
+                                 baked_at.replace(":", "").replace("-", ""))
+
+  # The instance was just rebooted and is idle, so skip the extra reboot.
+  image_id = connection.create_image(instance_id, name,
+                                     description="Grab Bag recipe {}".format(
+                                       recipe_hash),
+                                     no_reboot=True)
+  _create_tags(connection, image_id, {
+    _BAKE_DATETIME_TAG: baked_at,
+    _BAKE_HASH_TAG: recipe_hash
+  })
+  print("Baking image {} for recipe {}".format(image_id, recipe_hash))
+
+  if keep_bakes:
+    _evict_baked_images(connection, keep_bakes)
+
+
+def _benchmark_ephemeral_raid(checkpoint,
+  raid_directory_path="/mnt/ephemeral"):
+  """Benchmarks the ephemeral RAID array on the host checkpoint is for and
+  records the results against its instance."""
+  results = common.benchmark_directory(raid_directory_path)
+  instance_type = _find_instance_type(checkpoint["instance_type"])
+  connection = common.connect_region(checkpoint["region"])
+
+  common.record_benchmark(connection, checkpoint["instance_id"],
+                          raid_directory_path, results, {
+                            'disk_size': instance_type.ephemeral_disk_size,
+                            'instance_type': instance_type.name,
+                            'level': "0",
+                            'members': instance_type.ephemeral_disk_count,
+                            'profile': checkpoint.get(
+                              "raid_profile",
+                              common.get_default_raid_profile())
+                          })
 
 
 def _clone():
@@ -151,56 +270,127 @@ def _create_device_map(ephemeral_disk_count):
   return device_map
 
 
-def _create_ephemeral_raid(ephemeral_disk_count, raid_device_path="/dev/md0",
-  raid_directory_path="/mnt/ephemeral"):
-  """Creates a RAID array out of the ephemeral disks, using device path
-  raid_device_path and mounted at mount point raid_directory_path.
+def _create_ephemeral_raid(ephemeral_disk_count, raid_profile,
+  raid_device_path="/dev/md0", raid_directory_path="/mnt/ephemeral"):
+  """Creates a RAID array out of the ephemeral disks found on the host,
+  where the catalog expects ephemeral_disk_count, tuned with the profile
+  named raid_profile, using device path raid_device_path and mounted at
+  mount point raid_directory_path.
   This function generally follows the method outlined here:
   http://www.gabrielweinberg.com/blog/2011/05/raid0-ephemeral-storage-on-aws-ec2.html"""  # pylint: disable=C0301
-  device_paths = _get_device_paths(ephemeral_disk_count)
-  device_paths_string = " ".join(device_paths)
-
-  mdadm_parameters = [
-    "--create {}".format(raid_device_path),
-    "--chunk=256",
-    "--level=0",
-    "--raid-devices={}".format(len(device_paths)),
-    device_paths_string
-  ]
+  common.run_steps("create ephemeral raid", _get_ephemeral_raid_commands(
+    ephemeral_disk_count, raid_profile, raid_device_path,
+    raid_directory_path))
+
+
+def _create_tags(connection, resource_id, tags):
+  """Tags resource_id, retrying since new resources aren't always visible to
+  the tagging API straight away."""
+  for attempt in range(1, 4):
+    try:
+      connection.create_tags([resource_id], tags)
 
-  sudo("umount /dev/sdb || true")
-  sudo("yes | mdadm {}".format(" ".join(mdadm_parameters)))
-  sudo("echo 'DEVICE {}' >> /etc/mdadm.conf".format(device_paths_string))
-  sudo("mdadm --detail --scan >> /etc/mdadm.conf")
-  sudo("blockdev --setra 65536 {}".format(raid_device_path))
-  sudo("mkfs.xfs -f {}".format(raid_device_path))
-  sudo("mkdir -p {}".format(raid_directory_path))
-
-  fstab_line_parts = [
-    raid_device_path,
-    raid_directory_path,
-    "xfs",
-    "defaults,noatime",
-    "0",
-    "0"
+      break
+    except EC2ResponseError:
+      print("Create tags failed, sleeping (attempt={})".format(attempt))
+      time.sleep(1)
+
+
+def _evict_baked_images(connection, keep_bakes):
+  """Deregisters all but the newest keep_bakes baked AMIs, along with their
+  snapshots."""
+  images = connection.get_all_images(owners=["self"], filters={
+    "tag-key": _BAKE_HASH_TAG
+  })
+  images.sort(key=lambda image: image.tags.get(_BAKE_DATETIME_TAG, ""),
+              reverse=True)
+
+  for image in images[keep_bakes:]:
+    print("Deregistering old baked image {}".format(image.id))
+    connection.deregister_image(image.id, delete_snapshot=True)
+
+
+def _find_baked_image(connection, recipe_hash):
+  """Returns the newest available AMI baked from recipe_hash, or None."""
+  images = connection.get_all_images(owners=["self"], filters={
+    "state": "available",
+    "tag:{}".format(_BAKE_HASH_TAG): recipe_hash
+  })
+
+  if not images:
+    return None
+
+  return max(images, key=lambda image: image.tags.get(_BAKE_DATETIME_TAG, ""))
+
+
+def _find_checkpointed_instances(instance_ids):
+  """Looks up the instances with the ids in instance_ids, which must all be
+  running and have checkpoints from the same region. Returns a connection
+  to that region and the instances, in the same order as instance_ids."""
+  regions = set(_load_checkpoint(instance_id)["region"]
+                for instance_id in instance_ids)
+  if len(regions) > 1:
+    sys.exit("Can't resume instances from more than one region")
+
+  connection = common.connect_region(regions.pop())
+  found = {}
+
+  # A filter leaves out ids that no longer exist instead of failing on them.
+  filters = {'instance-id': list(instance_ids)}
+  for reservation in connection.get_all_instances(filters=filters):
+    for instance in reservation.instances:
+      found[instance.id] = instance
+
+  for instance_id in instance_ids:
+    state = found[instance_id].state if instance_id in found else "missing"
+    if state != "running":
+      sys.exit("Not running: {} {}".format(instance_id, state))
+
+  return connection, [found[instance_id] for instance_id in instance_ids]
+
+
+def _find_instance_type(name):
+  """Returns the _InstanceType called name."""
+  for instance_type in _load_instance_types():
+    if instance_type.name == name:
+      return instance_type
+
+  sys.exit("Unknown instance type {}".format(name))
+
+
+def _get_base_steps(checkpoint):
+  """Returns the (step, function, args) tuples that do the provisioning that
+  is the same for every host, which is what gets baked into an AMI with
+  --bake. With user data, that is just waiting for user data to finish."""
+  if checkpoint["user_data"]:
+    instance_type = _find_instance_type(checkpoint["instance_type"])
+    return [
+      ("user data", _wait_for_user_data,
+       [_get_user_data_commands(
+         instance_type,
+         checkpoint.get("raid_profile",
+                        common.get_default_raid_profile()))])
+    ]
+
+  return [
+    ("system files", _update_system_files, []),
+    ("install", _install, []),
+    ("installed files", _update_installed_files, []),
+    ("reboot", reboot, [])
   ]
 
-  sudo("echo '{}' >> /etc/fstab".format(" ".join(fstab_line_parts)))
-  sudo("mount {}".format(raid_device_path))
-  sudo("chown ec2-user:ec2-user {}".format(raid_directory_path))
 
-  # Manually assembles RAID array.  This should be done automatically at boot,
-  # but that doesn't seem to happen.
-  sudo("echo '/sbin/mdadm -A {}' >> /etc/rc.local".format(raid_device_path))
-  sudo("echo '/bin/mount {}' >> /etc/rc.local".format(raid_device_path))
-  sudo("echo '/sbin/blockdev --setra 65536 {}' >> /etc/rc.local".format(
-    raid_device_path))  # ensures blockdev runs on every start up
-  sudo("dracut --force")
+def _get_checkpoint_path(instance_id):
+  """Returns the path of the checkpoint file for instance_id."""
+  return os.path.join(_CHECKPOINT_DIRECTORY_PATH,
+                      "{}.json".format(instance_id))
 
 
 def _get_device_paths(count):
-  """Returns a list of device paths. The device paths are ordered
-  alphabetically starting with /dev/sdb, followed by /dev/sdc and /dev/sdd."""
+  """Returns a list of device paths for the block device map. The device
+  paths are ordered alphabetically starting with /dev/sdb, followed by
+  /dev/sdc and /dev/sdd. The host may name the disks differently, such as
+  /dev/xvdb or /dev/nvme1n1."""
   device_paths = []
 
   for index in range(count):
@@ -210,19 +400,180 @@ def _get_device_paths(count):
   return device_paths
 
 
+def _get_ephemeral_raid_commands(ephemeral_disk_count, raid_profile,
+  raid_device_path="/dev/md0", raid_directory_path="/mnt/ephemeral"):
+  """Returns the commands that build the ephemeral RAID array. The first
+  command finds the instance store disks on the host and lists them in
+  _EPHEMERAL_DEVICES_PATH for the rest to use, since each runs in its own
+  shell. Every disk found is striped, and the array and its file system
+  alignment are sized from that count. The build stops if fewer than 2
+  disks are found, and warns if the count isn't ephemeral_disk_count, what
+  the catalog expects."""
+  devices = "$(cat {})".format(_EPHEMERAL_DEVICES_PATH)
+  disk_count = "$(wc -l < {})".format(_EPHEMERAL_DEVICES_PATH)
+
+  return [
+    _get_ephemeral_discovery_command(),
+    "count={0}; [ $count -ge 2 ] || {{ echo \"Found $count ephemeral "
+    "disks, need at least 2\" >&2; exit 1; }}; [ $count -eq {1} ] || "
+    "echo \"Warning: found $count ephemeral disks, the catalog lists {1}\" "
+    ">&2".format(disk_count, ephemeral_disk_count),
+    "for device in {}; do umount $device || true; done".format(devices)
+  ] + common.get_raid_commands(devices, disk_count, "0", raid_device_path,
+                               raid_directory_path, raid_profile) + [
+    "dracut --force"
+  ]
+
+
+def _get_ephemeral_discovery_command():
+  """Returns the command that writes the device paths of the instance store
+  disks on the host to _EPHEMERAL_DEVICES_PATH, one per line. NVMe instance
+  store disks are told apart from NVMe EBS volumes by their model in sysfs.
+  Older disks are found from the ephemeral entries in the instance metadata
+  block device mapping, as /dev/sdX or /dev/xvdX, whichever exists."""
+  mapping_url = "{}/block-device-mapping".format(_METADATA_URL)
+
+  return " ".join([
+    "mkdir -p $(dirname {0}) && {{".format(_EPHEMERAL_DEVICES_PATH),
+    "for block in /sys/block/nvme*n1; do",
+    "grep -qs 'Instance Storage' $block/device/model &&",
+    "echo /dev/${block##*/};",
+    "done;",
+    "for mapping in $(curl -sf {}/ | grep ephemeral); do".format(
+      mapping_url),
+    "name=$(curl -sf {}/$mapping);".format(mapping_url),
+    "for path in /dev/$name /dev/xvd${name#sd}; do",
+    "[ -b $path ] && echo $path && break;",
+    "done;",
+    "done;",
+    "}} | sort -u > {}".format(_EPHEMERAL_DEVICES_PATH)
+  ])
+
+
+def _get_host_name_commands(name):
+  """Returns the commands that give the host its name."""
+  return [
+    "hostname {}".format(name),
+    common.append_line_command("127.0.0.1   {}".format(name), "/etc/hosts"),
+    common.append_line_command("/bin/hostname {}".format(name),
+                               "/etc/rc.local")
+  ]
+
+
+def _get_host_steps(checkpoint):
+  """Returns the (step, function, args) tuples that do the provisioning
+  specific to the host checkpoint is for. The ephemeral RAID is left out
+  when user data already built it, but is still benchmarked if asked."""
+  instance_type = _find_instance_type(checkpoint["instance_type"])
+  steps = [("host name", _update_host_name, [checkpoint["name"]])]
+
+  if (not checkpoint["user_data"] and
+      instance_type.ephemeral_disk_count > 1):
+    steps.append(("ephemeral raid", _create_ephemeral_raid,
+                  [instance_type.ephemeral_disk_count,
+                   checkpoint.get("raid_profile",
+                                  common.get_default_raid_profile())]))
+
+  if _GIT_REPO:
+    steps.append(("clone", _clone, []))
+
+  if (checkpoint.get("benchmark") and
+      instance_type.ephemeral_disk_count > 1):
+    steps.append(("benchmark", _benchmark_ephemeral_raid, [checkpoint]))
+
+  return steps
+
+
+def _get_install_commands():
+  """Returns the commands that install the yum and gem packages."""
+  return [
+    "yum update --assumeyes",
+    "yum install {} --assumeyes".format(" ".join(_YUM_PACKAGES)),
+    "gem install {}".format(" ".join(_GEM_PACKAGES))
+  ]
+
+
+def _get_installed_file_commands():
+  """Returns the commands that update the php-fpm files."""
+  php_fpm_path = "/etc/php-fpm.d/www.conf"
+  return [
+    "sed 's/= apache/= ec2-user/' {} > php-fpm".format(php_fpm_path),
+    "mv php-fpm {}".format(php_fpm_path),
+    "chkconfig php-fpm on"
+  ]
+
+
+def _get_recipe_hash(region):
+  """Returns a hash of everything _provision_base does to an instance: the
+  base AMI and the commands it runs, including the package lists."""
+  recipe = {
+    "ami": _AMI[region.name],
+    "commands": (_get_system_file_commands() + _get_install_commands() +
+                 _get_installed_file_commands())
+  }
+
+  return hashlib.sha1(json.dumps(recipe, sort_keys=True)).hexdigest()
+
+
+def _get_system_file_commands():
+  """Returns the commands that update the system files."""
+  return [
+    "sed '/ephemeral/d' /etc/fstab > fstab",
+    "mv fstab /etc/fstab",
+    common.append_line_command("fs.file-max = 2097152", "/etc/sysctl.conf"),
+    common.append_line_command("net.core.somaxconn = 65536",
+                               "/etc/sysctl.conf"),
+    common.append_line_command("vm.overcommit_memory = 1",
+                               "/etc/sysctl.conf"),
+    common.append_line_command("* hard nofile 131072",
+                               "/etc/security/limits.conf"),
+    common.append_line_command("* soft nofile 131072",
+                               "/etc/security/limits.conf")
+  ]
+
+
+def _get_user_data_commands(instance_type, raid_profile):
+  """Returns the commands run from user data: everything _provision_base
+  does apart from the reboot, and the ephemeral RAID build tuned with the
+  profile named raid_profile."""
+  commands = (_get_system_file_commands() + _get_install_commands() +
+              _get_installed_file_commands())
+
+  if instance_type.ephemeral_disk_count > 1:
+    commands.extend(_get_ephemeral_raid_commands(
+      instance_type.ephemeral_disk_count, raid_profile))
+
+  return commands
+
+
+def _get_wait_timings(wait_times):
+  """Returns (step, seconds) tuples with the time spent in each kind of
+  common.wait_for wait since wait_times, an earlier get_wait_times(), such
+  as waiting for the remote port or login. Fabric runs each host in a
+  process of its own, so these would otherwise be lost."""
+  return [(_WAIT_STEP_PREFIX + description,
+           seconds - wait_times.get(description, 0))
+          for description, seconds
+          in sorted(common.get_wait_times().iteritems())
+          if seconds > wait_times.get(description, 0)]
+
+
 def _install():
   """Installs important yum and gem packages."""
-  sudo("yum update --assumeyes")
-  sudo("yum install {} --assumeyes".format(" ".join(_YUM_PACKAGES)))
-  sudo("gem install {}".format(" ".join(_GEM_PACKAGES)))
+  common.run_steps("install", _get_install_commands())
 
 
-def _launch(connection, arguments, region):
-  """Launches a new instance in region."""
+def _launch(connection, arguments):
+  """Launches one new instance per name in arguments.names from
+  arguments.image_id, with a single run_instances call. Returns the running
+  instances, in the same order as arguments.names."""
   print("Launching {}".format(arguments))
+  count = len(arguments.names)
   instance_type = arguments.instance_type
   device_map = _create_device_map(instance_type.ephemeral_disk_count)
-  reservation = connection.run_instances(_AMI[region.name],
+  reservation = connection.run_instances(arguments.image_id,
+                                         min_count=count,
+                                         max_count=count,
                                          block_device_map=device_map,
                                          instance_type=instance_type.name,
                                          key_name=arguments.key_name,
@@ -230,91 +581,338 @@ def _launch(connection, arguments, region):
                                          placement=arguments.zone,
                                          security_groups=[
                                            arguments.security_group
-                                         ])
-  instance = reservation.instances[0]
-
-  for attempt in range(1, 4):
-    try:
-      connection.create_tags([instance.id], {
-        'Name': arguments.name
-      })
-
-      break
-    except EC2ResponseError:
-      print("Create name tag failed, sleeping (attempt={})".format(attempt))
-      time.sleep(1)
-
-  print("Waiting for instance to start")
-  status = instance.update()
-
-  while status == "pending":
-    time.sleep(_WAIT_FOR_START_INTERVAL)
-    status = instance.update()
-
-  if status == "running":
-    print("Launched {} at {}".format(instance.id, instance.public_dns_name))
-  else:
-    sys.exit("Not running: {}".format(status))
-
-  return instance.public_dns_name
+                                         ],
+                                         user_data=arguments.user_data)
+  instances = reservation.instances
+
+  for instance, name in zip(instances, arguments.names):
+    _create_tags(connection, instance.id, {
+      'Name': name
+    })
+
+  print("Waiting for {} instance(s) to start".format(count))
+  started = common.wait_for_instances(connection,
+                                      [instance.id for instance in instances])
+  instances = [started[instance.id] for instance in instances]
+
+  for instance in instances:
+    if instance.state == "running":
+      print("Launched {} at {}".format(instance.id, instance.public_dns_name))
+    else:
+      sys.exit("Not running: {} {}".format(instance.id, instance.state))
+
+  for description, seconds in sorted(common.get_wait_times().iteritems()):
+    print("Waited {:.1f} seconds for {}".format(seconds, description))
+
+  return instances
+
+
+def _load_checkpoint(instance_id):
+  """Returns the checkpoint saved for instance_id, a dict with the options
+  it was launched with and the steps completed on it."""
+  path = _get_checkpoint_path(instance_id)
+  if not os.path.exists(path):
+    sys.exit("No checkpoint for {} at {}".format(instance_id, path))
+
+  with open(path) as checkpoint_file:
+    return json.load(checkpoint_file)
+
+
+def _load_instance_types():
+  """Returns the instance types in common.get_instance_types_path(), sorted
+  by name. Each one records how many ephemeral disks it has and their
+  size."""
+  path = common.get_instance_types_path()
+  try:
+    with open(path, "r") as instance_types_file:
+      catalog = json.load(instance_types_file)
+  except (IOError, ValueError) as error:
+    sys.exit("Could not load instance types from {}: {}".format(path, error))
+
+  return [_InstanceType(name, details["ephemeral_disk_count"],
+                        details["ephemeral_disk_size"])
+          for name, details in sorted(catalog.iteritems())]
+
+
+def _merge_timings(timings, results):
+  """Adds the step timings returned by executing a provisioning task to
+  timings, both keyed by host string. A host whose task failed gets its
+  result in place of its timings."""
+  for host_string, host_timings in results.iteritems():
+    if isinstance(host_timings, list) and isinstance(
+      timings.get(host_string), list):
+      timings[host_string].extend(host_timings)
+    else:
+      timings[host_string] = host_timings
+
+
+def _print_timings(hosts, timings):
+  """Prints how long each provisioning step took on each host. timings is
+  the result of executing _provision, keyed by host string. The waits
+  within the steps are listed after each host's total, which they're
+  already part of."""
+  template = "{:28} {:34} {:>10}"
+  print(template.format("NAME", "STEP", "SECONDS"))
+
+  for host_string, name in sorted(hosts.items(), key=lambda item: item[1]):
+    host_timings = timings.get(host_string)
+    if not isinstance(host_timings, list):
+      print(template.format(name, "failed", "-"))
+      continue
+
+    steps = [(step, seconds) for step, seconds in host_timings
+             if not step.startswith(_WAIT_STEP_PREFIX)]
+    for step, seconds in steps:
+      print(template.format(name, step, "{:.1f}".format(seconds)))
+    print(template.format(name, "total", "{:.1f}".format(
+      sum(seconds for _, seconds in steps))))
+    for step, seconds in host_timings:
+      if step.startswith(_WAIT_STEP_PREFIX):
+        print(template.format(name, step, "{:.1f}".format(seconds)))
 
 
 def _prompt_instance_type():
   """Prompts for an instance type."""
   instance_types = [(instance_type.name, instance_type)
-                    for instance_type in _INSTANCE_TYPES]
+                    for instance_type in _load_instance_types()]
 
   return common.prompt_choice("Instance type", instance_types,
                               _DEFAULT_INSTANCE_TYPE)
 
 
-def _prompt_name(connection, prefix):
+def _prompt_names(connection, prefix, count=1):
   """Prompts for a name for the new instance. This prompt function will
   ask to use a smart default given by the prefix provided plus the next
   available number unused by any existing instances over the connection.
   For example, if prefix is 'redis' and you already have 'redis1' then
-  the suggested default will be 'redis2'."""
+  the suggested default will be 'redis2'. When count is more than one, the
+  names continue that sequence instead, such as 'redis2' and 'redis3'.
+  Returns a list of names."""
   instances = []
   highest_number = 0
 
   for reservation in connection.get_all_instances():
-    instance = reservation.instances[0]
-    name = instance.tags.get("Name")
+    for instance in reservation.instances:
+      name = instance.tags.get("Name")
 
-    if name and name.startswith(prefix):
-      instances.append((name, instance))
+      if name and name.startswith(prefix):
+        instances.append((name, instance))
 
-      try:
-        number = int(name[len(prefix)])
-        highest_number = max(highest_number, number)
-      except ValueError:
-        pass
+        try:
+          number = int(name[len(prefix):])
+          highest_number = max(highest_number, number)
+        except ValueError:
+          pass
 
   for name, instance in sorted(instances):
     print("{}: {}".format(name, instance.state))
 
-  return prompt("Name?", default="{}{}".format(prefix, highest_number + 1))
+  if count == 1:
+    return [prompt("Name?", default="{}{}".format(prefix,
+                                                  highest_number + 1))]
+
+  names = ["{}{}".format(prefix, highest_number + index)
+           for index in range(1, count + 1)]
+  print("Names: {}".format(", ".join(names)))
+
+  return names
+
+
+def _provision(instance_ids):
+  """Runs the host steps for the host Fabric is currently executing on,
+  whose instance id is looked up in instance_ids. Returns a list of (step,
+  seconds) tuples with how long each step took."""
+  checkpoint = _load_checkpoint(instance_ids[env.host_string])
+  wait_times = common.get_wait_times()
+  timings = []
+
+  _run_step(timings, "wait", common.wait_until_remote_reachable)
+  _run_pipeline(checkpoint, _get_host_steps(checkpoint), timings)
+
+  return timings + _get_wait_timings(wait_times)
+
+
+def _provision_base(instance_ids):
+  """Runs the base steps for the host Fabric is currently executing on,
+  whose instance id is looked up in instance_ids. Returns a list of (step,
+  seconds) tuples with how long each step took."""
+  checkpoint = _load_checkpoint(instance_ids[env.host_string])
+  wait_times = common.get_wait_times()
+  timings = []
+
+  _run_step(timings, "wait", common.wait_until_remote_reachable)
+  _run_pipeline(checkpoint, _get_base_steps(checkpoint), timings)
+
+  return timings + _get_wait_timings(wait_times)
+
+
+def _provision_instances(connection, instances, pool_size, recipe_hash=None,
+                         keep_bakes=0):
+  """Provisions instances, which must all have checkpoints, skipping the
+  steps that are already done. If recipe_hash is given, the first instance
+  is baked into an AMI between the base and host steps."""
+  host_strings = [instance.public_dns_name for instance in instances]
+  instance_ids = {instance.public_dns_name: instance.id
+                  for instance in instances}
+  checkpoints = [_load_checkpoint(instance.id) for instance in instances]
+  hosts = dict(zip(host_strings,
+                   [checkpoint["name"] for checkpoint in checkpoints]))
+  env.key_filename = sorted(set(checkpoint["key_path"]
+                                for checkpoint in checkpoints))
+  env.user = _USERNAME
+  env.parallel = len(host_strings) > 1
+  env.pool_size = pool_size
+
+  timings = {host_string: [] for host_string in host_strings}
+
+  _merge_timings(timings, execute(_provision_base, instance_ids,
+                                  hosts=host_strings))
+
+  if recipe_hash:
+    _bake_image(connection, instances[0].id, recipe_hash, keep_bakes)
+
+  _merge_timings(timings, execute(_provision, instance_ids,
+                                  hosts=host_strings))
+  _print_timings(hosts, timings)
+
+
+def _read_user_data_status():
+  """Returns the exit status written by the user-data script, or None if it
+  hasn't finished yet."""
+  with settings(hide("running", "stdout", "warnings"), warn_only=True):
+    status = run("cat {}".format(_USER_DATA_STATUS_PATH))
+
+  return status if status.succeeded else None
+
+
+def _refresh_instance_types(connection):
+  """Rebuilds common.get_instance_types_path() from DescribeInstanceTypes in
+  the region connection is for. Besides the ephemeral disks, each type
+  records its maximum EBS IOPS and throughput in MB/s, which create_raid
+  plans within."""
+  catalog = {}
+  params = {'MaxResults': 100}
+
+  while True:
+    root = common.call_ec2_api(connection, "DescribeInstanceTypes", params)
+
+    for item in root.iter("item"):
+      name = item.findtext("instanceType")
+      if not name:
+        continue
+
+      disks = item.findall("instanceStorageInfo/disks/item")
+      ebs_max_iops = item.findtext("ebsInfo/ebsOptimizedInfo/maximumIops")
+      ebs_max_throughput = item.findtext(
+        "ebsInfo/ebsOptimizedInfo/maximumThroughputInMBps")
+      catalog[name] = {
+        'ebs_max_iops': int(ebs_max_iops) if ebs_max_iops else None,
+        'ebs_max_throughput': (float(ebs_max_throughput)
+                               if ebs_max_throughput else None),
+        'ephemeral_disk_count': sum(int(disk.findtext("count"))
+                                    for disk in disks),
+        'ephemeral_disk_size': max([int(disk.findtext("sizeInGB"))
+                                    for disk in disks] or [0])
+      }
+
+    params['NextToken'] = root.findtext("nextToken")
+    if not params['NextToken']:
+      break
+
+  path = common.get_instance_types_path()
+  with open(path, "w") as instance_types_file:
+    json.dump(catalog, instance_types_file, indent=2, separators=(",", ": "),
+              sort_keys=True)
+    instance_types_file.write("\n")
+
+  print("Wrote {} instance types to {}".format(len(catalog), path))
+
+
+def _render_user_data(commands):
+  """Renders commands into a user-data script that cloud-init runs while the
+  instance boots. The step output goes to _USER_DATA_LOG_PATH and the exit
+  status is written to _USER_DATA_STATUS_PATH once the commands are done."""
+  return "\n".join([
+    "#!/bin/bash",
+    "cd /root",
+    "mkdir -p {}".format(os.path.dirname(_USER_DATA_STATUS_PATH)),
+    "bash > {} 2>&1 <<'GRAB_BAG_STEPS'".format(_USER_DATA_LOG_PATH),
+    common.render_steps_script("user data", commands) + "GRAB_BAG_STEPS",
+    "echo $? > {}".format(_USER_DATA_STATUS_PATH)
+  ]) + "\n"
+
+
+def _run_pipeline(checkpoint, steps, timings):
+  """Runs each (step, function, args) tuple in steps unless checkpoint lists
+  the step as completed. Each step is added to the list and the checkpoint
+  saved as soon as it finishes, so --resume carries on from the first step
+  that didn't."""
+  for step, function, args in steps:
+    if step in checkpoint["completed"]:
+      print("Skipping {}, already done".format(step))
+      continue
+
+    _run_step(timings, step, function, *args)
+    checkpoint["completed"].append(step)
+    _save_checkpoint(checkpoint)
+
+
+def _run_step(timings, step, function, *args):
+  """Calls function with args and appends (step, seconds taken) to
+  timings."""
+  start = time.time()
+  function(*args)
+  timings.append((step, time.time() - start))
+
+
+def _save_checkpoint(checkpoint):
+  """Writes checkpoint to the file for its instance, renaming a temporary
+  file over the old one so an interrupted run never leaves it half
+  written."""
+  if not os.path.isdir(_CHECKPOINT_DIRECTORY_PATH):
+    os.makedirs(_CHECKPOINT_DIRECTORY_PATH)
+
+  path = _get_checkpoint_path(checkpoint["instance_id"])
+  temporary_path = "{}.tmp".format(path)
+
+  with open(temporary_path, "w") as checkpoint_file:
+    json.dump(checkpoint, checkpoint_file, indent=2, sort_keys=True)
+
+  os.rename(temporary_path, path)
+
+
+def _update_host_name(name):
+  """Sets the host name now and on every boot."""
+  common.run_steps("update host name", _get_host_name_commands(name))
 
 
 def _update_installed_files():
   """Updates the php-fpm files."""
-  php_fpm_path = "/etc/php-fpm.d/www.conf"
-  sudo("sed 's/= apache/= ec2-user/' {} > php-fpm".format(php_fpm_path))
-  sudo("mv php-fpm {}".format(php_fpm_path))
-  sudo("chkconfig php-fpm on")
+  common.run_steps("update installed files", _get_installed_file_commands())
 
 
-def _update_system_files(name):
+def _update_system_files():
   """Updates the system files with config info for the RAID."""
-  sudo("sed '/ephemeral/d' /etc/fstab > fstab")
-  sudo("mv fstab /etc/fstab")
-  sudo("echo '127.0.0.1   {}' >> /etc/hosts".format(name))
-  sudo("echo /bin/hostname {} >> /etc/rc.local".format(name))
-  sudo("echo fs.file-max = 2097152 >> /etc/sysctl.conf")
-  sudo("echo net.core.somaxconn = 65536 >> /etc/sysctl.conf")
-  sudo("echo vm.overcommit_memory = 1 >> /etc/sysctl.conf")
-  sudo("echo '* hard nofile 131072' >> /etc/security/limits.conf")
-  sudo("echo '* soft nofile 131072' >> /etc/security/limits.conf")
+  common.run_steps("update system files", _get_system_file_commands())
+
+
+def _wait_for_user_data(commands):
+  """Waits until the user-data script rendered from commands has finished on
+  the host Fabric is currently executing on, then prints how long each
+  command took. Aborts if the script failed."""
+  status = common.wait_for(_read_user_data_status, "user data",
+                           _USER_DATA_TIMEOUT)
+
+  with hide("running", "stdout"):
+    output = sudo("cat {}".format(_USER_DATA_LOG_PATH))
+
+  for command, exit_status, seconds in common.parse_step_output(commands,
+                                                                output):
+    print("{:>8.2f}s {:>3} {}".format(seconds, exit_status, command))
+
+  if status.strip() != "0":
+    abort("User data failed with status {}, see {}".format(
+      status.strip(), _USER_DATA_LOG_PATH))
 
 
 if __name__ == "__main__":
@@ -9,21 +9,83 @@
 from __future__ import print_function
 
 # Standard Modules
+from collections import namedtuple
+import argparse
+import json
+import os
 import re
 import sys
-import time
 
 # Third-Party Modules
-from fabric.api import env, prompt, sudo
+from fabric.api import env, hide, prompt, run, sudo
 
 # Local Modules
 import common
 
 
+_ATTACH_TIMEOUT = 300  # seconds
 _DEFAULT_LEVEL = "0"
-_DELAY_FOR_VOLUMES_TO_ATTACH = 4  # seconds
+_DEFAULT_VOLUME_TYPE = "gp3"
+_GIBIBYTE = 1024 * 1024 * 1024
+_MAX_MEMBERS = 10
+_RESHAPE_TIMEOUT = 172800  # seconds
+_STATE_DIRECTORY_PATH = "/var/lib/grab-bag"
 _USERNAME = "ec2-user"
 
+# The fewest members mdadm builds each level with.
+_MIN_MEMBERS = {
+  '0': 2,
+  '1': 2,
+  '10': 4,
+  '4': 3,
+  '5': 3,
+  '6': 4
+}
+
+_ArrayDetails = namedtuple("_ArrayDetails", [
+  "level",
+  "members",  # device paths, in RAID device order
+  "member_size",  # GiB, of the smallest member
+  "mount"  # None when the array isn't mounted
+])
+
+_RaidPlan = namedtuple("_RaidPlan", [
+  "level",
+  "members",
+  "volume",
+  "iops",
+  "throughput"  # MB/s
+])
+
+_VolumePlan = namedtuple("_VolumePlan", [
+  "volume_type",
+  "size",  # GiB
+  "iops",
+  "throughput",  # MB/s
+  "provisioned_iops",  # None unless set when creating the volume
+  "provisioned_throughput"
+])
+
+_VolumeType = namedtuple("_VolumeType", [
+  "min_size",  # GiB
+  "max_size",
+  "max_iops",
+  "max_throughput",  # MB/s
+  "iops_per_gib",  # gp2's baseline, or the most that can be provisioned
+  "throughput_per_tib"  # st1 and sc1's baseline, in MB/s
+])
+
+# http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ebs-volume-types.html
+_VOLUME_TYPES = {
+  'gp2': _VolumeType(1, 16384, 16000, 250, 3, None),
+  'gp3': _VolumeType(1, 16384, 16000, 1000, 500, None),
+  'io1': _VolumeType(4, 16384, 64000, 1000, 50, None),
+  'io2': _VolumeType(4, 16384, 64000, 1000, 500, None),
+  'sc1': _VolumeType(125, 16384, 250, 250, None, 12),
+  'st1': _VolumeType(125, 16384, 500, 500, None, 40),
+  'standard': _VolumeType(1, 1024, 100, 40, None, None)
+}
+
 # http://en.wikipedia.org/wiki/Mdadm#RAID_Configurations
 _LEVELS = [
   "0",
@@ -39,10 +101,19 @@ _LEVELS = [
 
 
 def main():
+  parser = argparse.ArgumentParser(
+    description="Creates a RAID array out of new EBS volumes.")
+  parser.add_argument("--grow", action="store_true",
+                      help="adds new EBS volumes to an existing array "
+                           "instead, reshaping it onto them and growing its "
+                           "file system while it stays mounted")
+  options = parser.parse_args()
+
   connection = common.connect()
 
   instance = common.prompt_instance(connection,
-    "Which instance to create a RAID for")
+    "Which instance to {} a RAID for".format(
+      "grow" if options.grow else "create"))
   if not instance:
     sys.exit("Instance not found.")
 
@@ -53,35 +124,29 @@ def main():
   env.key_filename = key_path
   env.user = _USERNAME
 
-  number_of_disks = common.prompt_choice(
-    "How many EBS volumes should be in the RAID array", range(1, 11), 4)
-  size_of_disks = _prompt_size()
+  if options.grow:
+    _grow(connection, instance)
+    return
+
   level = common.prompt_choice("Level", _LEVELS, _DEFAULT_LEVEL)
+  volume_type = common.prompt_choice("Volume type", sorted(_VOLUME_TYPES),
+                                     _DEFAULT_VOLUME_TYPE)
+  size_of_disks = _prompt_size()
+  plan = _prompt_plan(instance, level, volume_type, size_of_disks)
+  profile_name = common.prompt_choice("Tuning profile",
+                                      common.get_raid_profile_names(),
+                                      common.get_default_raid_profile())
 
   common.wait_until_remote_reachable()
 
-  possible_device_paths = ["/dev/sd" + chr(letter)
-    for letter in range(ord("f"), ord("z") + 1)]
-
-  # Remove used device paths from the list
-  used_devices = _get_existing_device_paths()
+  used_devices = common.get_used_device_paths(instance)
+  prefix_device_path = common.prompt_device_prefix(used_devices)
 
-  for used_device in used_devices:
-    used_device_no_trailing_digits = re.sub("\d+$", "", used_device)
-    if used_device_no_trailing_digits in possible_device_paths:
-      possible_device_paths.remove(used_device_no_trailing_digits)
-
-  # Offer the user a prompt of which device path to beginning with
-  prefix_device_path = common.prompt_choice(
-    "Volumes should be attached with numbers appended to which device path",
-    possible_device_paths[:9], 1)
-
-  # Create the disks
-  new_volume_device_strings = []
-  for index in range(number_of_disks):
-    device_string = prefix_device_path + str(index + 1)  # example: /dev/sdf2
-    new_volume_device_strings.append(device_string)
-    _create_ebs_volume(connection, instance, size_of_disks, device_string)
+  # Create the disks, attached at paths such as /dev/sdf1, /dev/sdf2
+  new_volume_device_strings = [prefix_device_path + str(index + 1)
+                               for index in range(plan.members)]
+  device_paths = _create_ebs_volumes(connection, instance, plan.volume,
+                                     new_volume_device_strings)
 
   # Figure out where to attach the new RAID
   possible_devices_for_raid = ["/dev/md" + str(index) for index in range(10)]
@@ -97,105 +162,460 @@ def main():
   if raid_directory_path == "":
     raid_directory_path = "/mnt/raid"
 
-  _create_raid(new_volume_device_strings, level, raid_device_path,
-               raid_directory_path)
+  _create_raid(device_paths, level, raid_device_path, raid_directory_path,
+               profile_name)
+
+  if common.prompt_confirmation("Benchmark the new RAID array"):
+    results = common.benchmark_directory(raid_directory_path)
+    common.record_benchmark(connection, instance.id, raid_directory_path,
+                            results, {
+                              'instance_type': instance.instance_type,
+                              'level': level,
+                              'members': plan.members,
+                              'profile': profile_name,
+                              'volume_iops': plan.volume.iops,
+                              'volume_size': plan.volume.size,
+                              'volume_throughput': plan.volume.throughput,
+                              'volume_type': plan.volume.volume_type
+                            })
+
+
+def _ceil_divide(numerator, denominator):
+  """Returns numerator divided by denominator, rounded up."""
+  return -(-numerator // denominator)
+
+
+def _create_ebs_volumes(connection, instance, volume_plan, device_paths):
+  """Creates one EBS volume as described by volume_plan for each device path
+  in device_paths and attaches them to instance. All the volumes are
+  created before waiting on any of them, then attached together once they
+  are all available, so they are provisioned side by side. Returns the
+  device paths the volumes showed up at on the host, in the same order as
+  device_paths. These can differ from device_paths, such as /dev/xvdf1 or
+  /dev/nvme1n1 for /dev/sdf1."""
+  instance_name = instance.tags.get("Name")
+  volume_ids = []
 
+  for device_path in device_paths:
+    volume_name = "{}-{}".format(instance_name,
+                                 device_path.replace("/dev/", ""))
+    volume_id = _create_volume(connection, instance.placement, volume_name,
+                               volume_plan)
+    print("Created EBS volume {} ({}) for {}".format(volume_id, volume_name,
+                                                     device_path))
+    volume_ids.append(volume_id)
 
-def _create_ebs_volume(connection, instance, size_of_volume, device_path):
-  """Creates an EBS volume of size size_of_volume, attaches it to instance at
-  the device path device_path."""
-  instance_name = instance.tags.get("Name")
-  volume_name = "{}-{}".format(instance_name, device_path.replace("/dev/", ""))
-  print("Creating EBS volume {} and attaching to {}".format(volume_name,
-    device_path))
-  new_volume = connection.create_volume(size_of_volume, instance.placement)
-
-  new_volume.attach(instance.id, device_path)
-  print("Ensuring {} is found as a device".format(device_path))
-  attempt = 0
-  while True:
-    attempt += 1
-    if device_path in _get_existing_device_paths():
-      break
-    else:
-      print("Couldn't find {} (attempt={})".format(device_path, attempt))
-      print("Sleeping {} seconds".format(_DELAY_FOR_VOLUMES_TO_ATTACH))
-      time.sleep(_DELAY_FOR_VOLUMES_TO_ATTACH)
-  print("Successfully found device attached.")
-
-  connection.create_tags([new_volume.id], {"Name": volume_name})
+  return common.attach_volumes(connection, instance.id, volume_ids,
+                               device_paths, _ATTACH_TIMEOUT)
 
 
 # Following this tutorial:
 # http://www.gabrielweinberg.com/blog/2011/05/raid0-ephemeral-storage-on-aws-ec2.html pylint: disable=C0301
-def _create_raid(device_paths, level, raid_device_path, raid_directory_path):
-  """Creates a RAID array made up of the storage found at device_paths."""
+def _create_raid(device_paths, level, raid_device_path, raid_directory_path,
+                 profile_name):
+  """Creates a RAID array made up of the storage found at device_paths, tuned
+  with the profile named profile_name."""
   print("Creating RAID array attached to {} with directory {}".format(
 raid_device_path, raid_directory_path))
 
-  device_paths_string = " ".join(device_paths)
+  common.run_steps("create raid", _get_raid_commands(device_paths, level,
+    raid_device_path, raid_directory_path, profile_name))
+
+
+def _create_volume(connection, zone, name, volume_plan):
+  """Creates an EBS volume in zone as described by volume_plan, tagged with
+  name as it is created. boto can't set gp3 throughput or tags on
+  creation, so the call is made with a newer API version. Returns the new
+  volume's id."""
+  params = {
+    'AvailabilityZone': zone,
+    'Size': volume_plan.size,
+    'TagSpecification.1.ResourceType': "volume",
+    'TagSpecification.1.Tag.1.Key': "Name",
+    'TagSpecification.1.Tag.1.Value': name,
+    'VolumeType': volume_plan.volume_type
+  }
+  if volume_plan.provisioned_iops:
+    params['Iops'] = volume_plan.provisioned_iops
+  if volume_plan.provisioned_throughput:
+    params['Throughput'] = volume_plan.provisioned_throughput
+
+  return common.call_ec2_api(connection, "CreateVolume",
+                             params).findtext("volumeId")
+
+
+def _get_array_details(raid_device_path):
+  """Returns the _ArrayDetails of the RAID array at raid_device_path on the
+  remote host."""
+  with hide("running", "stdout"):
+    detail = sudo("mdadm --detail {}".format(raid_device_path))
+    mount = run("awk '$1 == \"{}\" {{print $2}}' /proc/mounts".format(
+      raid_device_path))
+
+  level = re.search(r"Raid Level : raid(\w+)", detail).group(1)
+  members = re.findall(r"^\s*\d+\s+\d+\s+\d+\s+\d+\s.*\s(/dev/\S+)\s*$",
+                       detail, re.MULTILINE)
+
+  with hide("running", "stdout"):
+    sizes = sudo("blockdev --getsize64 {}".format(" ".join(members)))
+
+  return _ArrayDetails(level, members,
+                       min(int(size) for size in sizes.split()) // _GIBIBYTE,
+                       mount.strip() or None)
+
+
+def _get_array_paths():
+  """Returns the device paths of the RAID arrays on the remote host, from
+  /proc/mdstat."""
+  with hide("running", "stdout"):
+    mdstat = run("cat /proc/mdstat")
+
+  return ["/dev/{}".format(name)
+          for name in re.findall(r"^(md\d+) :", mdstat, re.MULTILINE)]
+
+
+def _get_grow_commands(raid_device_path, array, device_paths):
+  """Returns the commands that add device_paths to array, the _ArrayDetails
+  of the array at raid_device_path, and start reshaping it onto them. RAID
+  0 can't have spares, so there mdadm adds the devices as part of the
+  reshape, passing through RAID 4 while it runs."""
+  raid_devices = len(array.members) + len(device_paths)
+  devices = " ".join(device_paths)
+  # The grow is skipped if an earlier run already started it.
+  grown = ("[ $(mdadm --detail {} | awk '/Raid Devices/ {{print $4}}') "
+           "-ge {} ]".format(raid_device_path, raid_devices))
+  grow = "mdadm --grow {} --raid-devices={}".format(raid_device_path,
+                                                    raid_devices)
+
+  if array.level == "0":
+    return ["{} || {} --add {}".format(grown, grow, devices)]
+
+  if array.level in ("4", "5", "6"):
+    grow += " --backup-file={}/{}-grow.backup".format(
+      _STATE_DIRECTORY_PATH, os.path.basename(raid_device_path))
+
+  return [
+    "mkdir -p {}".format(_STATE_DIRECTORY_PATH),
+    "for device in {0}; do mdadm --detail {1} | grep -q \"$device$\" || "
+    "mdadm --add {1} $device; done".format(devices, raid_device_path),
+    "{} || {}".format(grown, grow)
+  ]
 
-  # Ensure yum packages are available (needed for mkfs.xfs command)
-  sudo("yum install xfsprogs --assumeyes")
 
-  # Create RAID array
-  mdadm_parameters = [
-    "--create {}".format(raid_device_path),
-    "--chunk=256",
-    "--level={}".format(level),
-    "--raid-devices={}".format(len(device_paths)),
-    device_paths_string
-  ]
-  sudo("yes | mdadm {}".format(" ".join(mdadm_parameters)))
-  sudo("echo 'DEVICE {}' >> /etc/mdadm.conf".format(device_paths_string))
-  sudo("mdadm --detail --scan | grep {} >> /etc/mdadm.conf".format(raid_device_path))
-  sudo("blockdev --setra 65536 {}".format(raid_device_path))
-
-  # Format with XFS file system
-  sudo("mkfs.xfs -f {}".format(raid_device_path))
-
-  # Make a directory and add it as the mount point
-  sudo("mkdir -p {}".format(raid_directory_path))
-  fstab_line_parts = [
-    raid_device_path,
-    raid_directory_path,
-    "xfs",
-    "defaults,noatime",
-    "0",
-    "0"
+def _get_grow_finish_commands(raid_device_path, array, device_paths):
+  """Returns the commands that finish growing array, the _ArrayDetails of
+  the array at raid_device_path from before device_paths were added, once
+  the reshape is done. The file system is grown to fill the array, and the
+  array's lines in /etc/mdadm.conf and /etc/rc.local are replaced rather
+  than added to."""
+  all_members = " ".join(array.members + device_paths)
+  old_members = " ".join(array.members)
+  commands = []
+
+  if array.level == "0":
+    # mdadm switches back from RAID 4 when the reshape is done, unless it
+    # was interrupted.
+    commands.append("mdadm --detail {0} | grep -q 'Raid Level : raid0' || "
+                    "mdadm --grow {0} --level=0".format(raid_device_path))
+
+  if array.mount:
+    commands.append("xfs_growfs {}".format(array.mount))
+
+  return commands + [
+    "sed -i '\\#^ARRAY {0} #d' /etc/mdadm.conf && mdadm --detail --scan | "
+    "grep '^ARRAY {0} ' >> /etc/mdadm.conf".format(raid_device_path),
+    "sed -i {} /etc/mdadm.conf".format(" ".join(
+      "-e '\\#^DEVICE .*{}\\( \\|$\\)#d'".format(member)
+      for member in array.members)),
+    common.append_line_command("DEVICE {}".format(all_members),
+                               "/etc/mdadm.conf"),
+    common.append_line_command("/sbin/mdadm -A {}".format(raid_device_path),
+                               "/etc/rc.local"),
+    common.append_line_command("/bin/mount {}".format(raid_device_path),
+                               "/etc/rc.local"),
+    # Moves the tuning profile's scheduler line onto all the members and
+    # reapplies it and the readahead, which the reshape resets.
+    "sed -i 's#^for device in {}; do for scheduler#"
+    "for device in {}; do for scheduler#' /etc/rc.local".format(
+      old_members, all_members),
+    "grep -F 'for device in {}; do for scheduler' /etc/rc.local | "
+    "bash".format(all_members),
+    "grep '^/sbin/blockdev --setra [0-9]* {}$' /etc/rc.local | bash".format(
+      raid_device_path)
   ]
-  sudo("echo '{}' >> /etc/fstab".format(" ".join(fstab_line_parts)))
-  sudo("mount {}".format(raid_device_path))
-  sudo("chown ec2-user:ec2-user {}".format(raid_directory_path))
 
-  # Manually assembles RAID array.  This should be done automatically at boot,
-  # but that doesn't seem to happen.
-  sudo("echo '/sbin/mdadm -A {}' >> /etc/rc.local".format(raid_device_path))
-  sudo("echo '/bin/mount {}' >> /etc/rc.local".format(raid_device_path))
-  sudo("echo '/sbin/blockdev --setra 65536 {}' >> /etc/rc.local".format(
-    raid_device_path))
 
+def _get_raid_commands(device_paths, level, raid_device_path,
+  raid_directory_path, profile_name):
+  """Returns the commands that build, tune, format and mount the RAID
+  array."""
+  return [
+    # Ensure yum packages are available (needed for mkfs.xfs command)
+    "yum install xfsprogs --assumeyes"
+  ] + common.get_raid_commands(" ".join(device_paths), len(device_paths),
+                               level, raid_device_path, raid_directory_path,
+                               profile_name)
 
-def _get_existing_device_paths():
-  ls_devices = re.findall(r'\w+', sudo("ls /dev"))
-  return ["/dev/" + device for device in ls_devices if device.strip() != ""]
 
+def _grow(connection, instance):
+  """Prompts for a RAID array on instance and adds new EBS volumes to it.
+  The volumes are created and attached together, then the array is
+  reshaped onto them and its file system grown, while it stays mounted."""
+  common.wait_until_remote_reachable()
+
+  array_paths = _get_array_paths()
+  if not array_paths:
+    sys.exit("No RAID arrays found.")
+
+  raid_device_path = common.prompt_choice("Which RAID array to grow",
+                                          array_paths)
+  array = _get_array_details(raid_device_path)
+  print("{} is RAID {} of {}, mounted at {}".format(
+    raid_device_path, array.level, " ".join(array.members), array.mount))
+
+  if len(array.members) >= _MAX_MEMBERS:
+    sys.exit("{} already has {} members.".format(raid_device_path,
+                                                 len(array.members)))
+
+  number_of_disks = common.prompt_choice(
+    "How many EBS volumes should be added",
+    range(1, _MAX_MEMBERS - len(array.members) + 1), 1)
+  volume_type = common.prompt_choice("Volume type", sorted(_VOLUME_TYPES),
+                                     _DEFAULT_VOLUME_TYPE)
+  # mdadm refuses members smaller than the existing ones, but only once the
+  # volumes have been created and attached, so they're refused here first.
+  size = _prompt_size(array.member_size, array.member_size)
+  volume_plan = _plan_volume(volume_type, size, 0, 0)
+
+  prefix_device_path = common.prompt_device_prefix(
+    common.get_used_device_paths(instance))
+  device_paths = _create_ebs_volumes(
+    connection, instance, volume_plan,
+    [prefix_device_path + str(index + 1) for index in range(number_of_disks)])
+
+  common.run_steps("grow raid", _get_grow_commands(raid_device_path, array,
+                                                   device_paths))
+  _wait_for_reshape(raid_device_path)
+  common.run_steps("finish raid grow", _get_grow_finish_commands(
+    raid_device_path, array, device_paths))
+
+
+def _load_ebs_limits(instance_type):
+  """Returns the most EBS IOPS and throughput in MB/s instance_type
+  supports, from common.get_instance_types_path(). Either is None if
+  unknown, with a warning if the catalog couldn't be read."""
+  path = common.get_instance_types_path()
+  try:
+    with open(path, "r") as instance_types_file:
+      details = json.load(instance_types_file).get(instance_type, {})
+  except (IOError, ValueError) as error:
+    print("Could not load EBS limits from {}, planning without them: {}"
+          .format(path, error), file=sys.stderr)
+    details = {}
+
+  return details.get("ebs_max_iops"), details.get("ebs_max_throughput")
+
+
+def _plan_raid(level, volume_type, size, iops, throughput, ebs_limits):
+  """Returns the _RaidPlan for the fewest volumes of volume_type, each at
+  least size GiB, that together deliver iops and throughput in MB/s at
+  level. Returns None if _MAX_MEMBERS volumes can't."""
+  for members in range(_MIN_MEMBERS.get(level, 2), _MAX_MEMBERS + 1):
+    if level == "10" and members % 2:
+      continue
+
+    data_disk_count = common.get_data_disk_count(level, members) or 1
+    volume_plan = _plan_volume(volume_type, size,
+                               _ceil_divide(iops, data_disk_count),
+                               _ceil_divide(throughput, data_disk_count))
+    if volume_plan:
+      return _project_raid(level, members, volume_plan, ebs_limits)
+
+  return None
+
+
+def _plan_volume(volume_type, size, iops, throughput):
+  """Returns the _VolumePlan for the smallest volume of volume_type that is
+  at least size GiB and delivers iops and throughput in MB/s. Provisioned
+  IOPS and throughput are kept to the least that does. Returns None if no
+  single volume can."""
+  limits = _VOLUME_TYPES[volume_type]
+  size = max(size, limits.min_size)
+  provisioned_iops = None
+  provisioned_throughput = None
+
+  if volume_type == "gp2":
+    size = max(size, _ceil_divide(iops, limits.iops_per_gib))
+    if throughput > 128:
+      size = max(size, 171)
+    volume_iops = min(max(100, limits.iops_per_gib * size), limits.max_iops)
+    volume_throughput = 250 if size > 170 else 128
+  elif volume_type == "gp3":
+    # Throughput can be at most a quarter of the IOPS, in MB/s.
+    provisioned_throughput = max(125, throughput)
+    provisioned_iops = max(3000, iops, provisioned_throughput * 4)
+    size = max(size, _ceil_divide(provisioned_iops, limits.iops_per_gib))
+    volume_iops = provisioned_iops
+    volume_throughput = provisioned_throughput
+  elif volume_type in ("io1", "io2"):
+    # Each I/O of up to 256 KiB counts as one operation.
+    provisioned_iops = max(100, iops, throughput * 4)
+    size = max(size, _ceil_divide(provisioned_iops, limits.iops_per_gib))
+    volume_iops = provisioned_iops
+    volume_throughput = min(provisioned_iops // 4, limits.max_throughput)
+  elif limits.throughput_per_tib:
+    size = max(size, _ceil_divide(throughput * 1024,
+                                  limits.throughput_per_tib))
+    volume_iops = limits.max_iops
+    volume_throughput = min(limits.throughput_per_tib * size // 1024,
+                            limits.max_throughput)
+  else:
+    volume_iops = limits.max_iops
+    volume_throughput = limits.max_throughput
+
+  if (size > limits.max_size or volume_iops > limits.max_iops or
+      volume_throughput > limits.max_throughput or volume_iops < iops or
+      volume_throughput < throughput):
+    return None
+
+  return _VolumePlan(volume_type, size, volume_iops, volume_throughput,
+                     provisioned_iops, provisioned_throughput)
+
+
+def _print_plan(plan, ebs_limits):
+  """Prints the volumes plan creates and what the array should deliver."""
+  volume = plan.volume
+  provisioned = [
+    "{} IOPS".format(volume.provisioned_iops)
+    if volume.provisioned_iops else None,
+    "{} MB/s".format(volume.provisioned_throughput)
+    if volume.provisioned_throughput else None
+  ]
+  provisioned = [setting for setting in provisioned if setting]
+
+  print("Volumes:   {} x {} GiB {}, {} IOPS and {} MB/s each{}".format(
+    plan.members, volume.size, volume.volume_type, volume.iops,
+    volume.throughput,
+    " (provisioned {})".format(" and ".join(provisioned))
+    if provisioned else ""))
+  print("Projected: {} IOPS and {} MB/s from RAID {}".format(
+    plan.iops, plan.throughput, plan.level))
+  print("Instance:  {} IOPS and {} MB/s of EBS at most".format(
+    *[limit or "unknown" for limit in ebs_limits]))
+
+
+def _project_raid(level, members, volume_plan, ebs_limits):
+  """Returns the _RaidPlan for members volumes described by volume_plan at
+  level, with the IOPS and throughput the array should deliver once the
+  instance's ebs_limits are taken into account."""
+  data_disk_count = common.get_data_disk_count(level, members) or 1
+  iops = volume_plan.iops * data_disk_count
+  throughput = volume_plan.throughput * data_disk_count
+  max_iops, max_throughput = ebs_limits
+
+  if max_iops:
+    iops = min(iops, max_iops)
+  if max_throughput:
+    throughput = min(throughput, max_throughput)
+
+  return _RaidPlan(level, members, volume_plan, iops, throughput)
+
+
+def _prompt_plan(instance, level, volume_type, size):
+  """Prompts for a target IOPS and throughput for the array, and plans the
+  fewest volumes that reach them within the instance's EBS limits. Without
+  targets, prompts for the number of volumes instead. Prints the plan and
+  exits unless it is confirmed."""
+  ebs_limits = _load_ebs_limits(instance.instance_type)
+  max_iops, max_throughput = ebs_limits
+  iops = _prompt_target("Target IOPS for the array", max_iops)
+  throughput = _prompt_target("Target MB/s for the array", max_throughput)
+
+  if iops or throughput:
+    plan = _plan_raid(level, volume_type, size, iops, throughput, ebs_limits)
+    if not plan:
+      sys.exit("No RAID {} of up to {} {} volumes reaches that".format(
+        level, _MAX_MEMBERS, volume_type))
+  else:
+    members = common.prompt_choice(
+      "How many EBS volumes should be in the RAID array",
+      range(1, _MAX_MEMBERS + 1), 4)
+    plan = _project_raid(level, members,
+                         _plan_volume(volume_type, size, 0, 0), ebs_limits)
+
+  _print_plan(plan, ebs_limits)
+  if not common.prompt_confirmation("Create these volumes", True):
+    sys.exit(0)
+
+  return plan
+
+
+def _prompt_size(default=10, minimum=1):
+  """Prompts for a volume size in GiB of at least minimum, up to 1000 or
+  minimum if that's more."""
+  maximum = max(minimum, 1000)
 
-def _prompt_size():
   def validate(value):
     try:
       value = int(value)
-      assert 1 <= value <= 1000
+      assert minimum <= value <= maximum
 
       return value
     except (AssertionError, ValueError):
-      raise Exception("Volume size must be between 1 and 1000.")
+      raise Exception("Volume size must be between {} and {}.".format(
+        minimum, maximum))
 
-  size = prompt("Volume size (GB) [1-1000]?", default="10", validate=validate)
+  size = prompt("Volume size (GB) [{}-{}]?".format(minimum, maximum),
+                default=str(default), validate=validate)
   print("Chose {}".format(size))
 
   return size
 
 
+def _prompt_target(question, limit):
+  """Prompts for a target number, 0 for none, capping it at limit unless
+  that is None."""
+  def validate(value):
+    try:
+      value = int(value)
+      assert value >= 0
+
+      return value
+    except (AssertionError, ValueError):
+      raise Exception("Target must be a whole number, 0 for none.")
+
+  target = prompt("{} (0 for none)?".format(question), default="0",
+                  validate=validate)
+  if limit and target > limit:
+    print("Capping {} at the instance's EBS limit of {}".format(target,
+                                                                limit))
+    target = int(limit)
+
+  return target
+
+
+def _wait_for_reshape(raid_device_path):
+  """Waits until the array at raid_device_path is no longer reshaping,
+  resyncing or recovering, printing its progress from /proc/mdstat."""
+  name = os.path.basename(raid_device_path)
+
+  def check():
+    with hide("running", "stdout"):
+      mdstat = run("cat /proc/mdstat")
+
+    for block in re.split(r"\n\s*\n", mdstat):
+      if block.startswith("{} :".format(name)):
+        progress = re.search(r"(reshape|resync|recovery)\s*=\s*(.*)", block)
+        if progress:
+          print("{} {} {}".format(name, progress.group(1),
+                                  progress.group(2).strip()))
+          return False
+
+    return True
+
+  common.wait_for(check, "{} to reshape".format(raid_device_path),
+                  _RESHAPE_TIMEOUT)
+
+
 if __name__ == "__main__":
   main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# This script runs the other scripts as subcommands, such as
+# "grab_bag.py backup --copy-region us-west-2", passing the rest of the
+# arguments on. Only the subcommand's own module is imported, so a run of
+# backup.py from cron doesn't pay for importing Fabric, and a run of
+# update_hosts.py doesn't either.
+#
+# "grab_bag.py --import-times" imports each subcommand's module in a fresh
+# interpreter, prints how long that took and which of boto and Fabric it
+# loaded, and exits with an error if a subcommand failed to import, took
+# longer than _IMPORT_TIME_LIMIT, or loaded a library it shouldn't need
+# until it runs.
+#
+# NO WARRANTY
+#
+# THE PROGRAM IS DISTRIBUTED IN THE HOPE THAT IT WILL BE USEFUL, BUT WITHOUT ANY WARRANTY. IT IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS WITH YOU. SHOULD THE PROGRAM PROVE DEFECTIVE, YOU ASSUME THE COST OF ALL NECESSARY SERVICING, REPAIR OR CORRECTION.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW THE AUTHOR WILL BE LIABLE TO YOU FOR DAMAGES, INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING OUT OF THE USE OR INABILITY TO USE THE PROGRAM (INCLUDING BUT NOT LIMITED TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER PROGRAMS), EVEN IF THE AUTHOR HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+
+from __future__ import print_function
+
+# Standard Modules
+from collections import namedtuple
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+
+_HEAVY_LIBRARIES = ["boto", "fabric"]
+_IMPORT_TIME_LIMIT = 2  # seconds
+
+# Prints the seconds an import took, then the top-level modules loaded.
+_IMPORT_TIMER = ("import sys, time; start = time.time(); import {}; "
+                 "print(time.time() - start); "
+                 "print(' '.join(set(name.split('.')[0] "
+                 "for name in sys.modules)))")
+
+_Subcommand = namedtuple("_Subcommand", [
+  "module",
+  "unused_libraries"  # of _HEAVY_LIBRARIES, the ones importing it can't load
+])
+
+_SUBCOMMANDS = {
+  'backup': _Subcommand("backup", ["boto", "fabric"]),
+  'create-instance': _Subcommand("create_instance", []),
+  'create-raid': _Subcommand("create_raid", ["boto"]),
+  'restore': _Subcommand("restore", ["boto"]),
+  'update-elb': _Subcommand("update_elb", ["fabric"]),
+  'update-hosts': _Subcommand("update_hosts", ["fabric"])
+}
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Runs one of the Grab Bag scripts.")
+  parser.add_argument("--import-times", action="store_true",
+                      help="measures how long each subcommand takes to "
+                           "import and checks which libraries it loads")
+  parser.add_argument("subcommand", nargs="?", choices=sorted(_SUBCOMMANDS))
+  parser.add_argument("arguments", nargs=argparse.REMAINDER,
+                      help="passed on to the subcommand")
+  options = parser.parse_args()
+
+  if options.import_times:
+    sys.exit(0 if _check_import_times() else 1)
+  if not options.subcommand:
+    parser.error("expected a subcommand")
+
+  module = importlib.import_module(_SUBCOMMANDS[options.subcommand].module)
+  sys.argv = (["{} {}".format(sys.argv[0], options.subcommand)] +
+              options.arguments)
+  module.main()
+
+
+def _check_import_times():
+  """Imports each subcommand's module in a fresh interpreter and prints the
+  seconds it took and the heavy libraries it loaded. Returns whether every
+  one of them imported without problems."""
+  passed = True
+
+  for name, subcommand in sorted(_SUBCOMMANDS.iteritems()):
+    try:
+      seconds, loaded = _time_import(subcommand.module)
+    except subprocess.CalledProcessError as error:
+      print("{:>16} failed to import: {}".format(
+        name, (error.output.strip().splitlines() or [error])[-1]))
+      passed = False
+      continue
+
+    problems = _get_import_problems(subcommand, seconds, loaded)
+    print("{:>16} {:>6.3f}s {}{}".format(
+      name, seconds, " ".join(loaded) or "-",
+      " ({})".format(", ".join(problems)) if problems else ""))
+    passed = passed and not problems
+
+  return passed
+
+
+def _get_import_problems(subcommand, seconds, loaded):
+  """Returns what's wrong with an import of subcommand's module that took
+  seconds and loaded the heavy libraries in loaded, if anything."""
+  problems = []
+
+  unexpected = [library for library in loaded
+                if library in subcommand.unused_libraries]
+  if unexpected:
+    problems.append("should not load {}".format(" ".join(unexpected)))
+  if seconds > _IMPORT_TIME_LIMIT:
+    problems.append("slower than {}s".format(_IMPORT_TIME_LIMIT))
+
+  return problems
+
+
+def _time_import(module):
+  """Imports module in a fresh interpreter. Returns the seconds it took and
+  which of _HEAVY_LIBRARIES it loaded. Raises CalledProcessError if the
+  import failed."""
+  output = subprocess.check_output(
+    [sys.executable, "-c", _IMPORT_TIMER.format(module)],
+    cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT)
+  seconds, modules = output.splitlines()[-2:]
+
+  return float(seconds), [library for library in _HEAVY_LIBRARIES
+                          if library in modules.split()]
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#
+# This script restores a group of snapshots taken by backup.py to an instance.
+# The snapshots backup.py takes of an array's members at the same time are
+# found by their Backup-Instance-Name, Backup-Datetime and Backup-Device
+# tags. A volume is created from each of them at once, and they are attached
+# together to the chosen instance, where the RAID array is assembled and
+# mounted. Volumes created from snapshots load their blocks from S3 the
+# first time they are read, so they can optionally be warmed by reading every
+# member in full, in parallel.
+#
+# NO WARRANTY
+#
+# THE PROGRAM IS DISTRIBUTED IN THE HOPE THAT IT WILL BE USEFUL, BUT WITHOUT ANY WARRANTY. IT IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS WITH YOU. SHOULD THE PROGRAM PROVE DEFECTIVE, YOU ASSUME THE COST OF ALL NECESSARY SERVICING, REPAIR OR CORRECTION.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW THE AUTHOR WILL BE LIABLE TO YOU FOR DAMAGES, INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING OUT OF THE USE OR INABILITY TO USE THE PROGRAM (INCLUDING BUT NOT LIMITED TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER PROGRAMS), EVEN IF THE AUTHOR HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+
+from __future__ import print_function
+
+# Standard Modules
+from collections import namedtuple
+import argparse
+import datetime
+import re
+import sys
+
+# Third-Party Modules
+from fabric.api import env, hide, sudo
+
+# Local Modules
+import common
+
+
+_ATTACH_TIMEOUT = 300  # seconds
+_DATETIME_FORMAT = "%Yy-%mm-%dd %Hh%Mm"
+_DEFAULT_DIRECTORY_PATH = "/mnt/restore"
+_DEFAULT_VOLUME_TYPE = "gp3"
+_MEBIBYTE = 1024 * 1024
+_USERNAME = "ec2-user"
+_VOLUME_TYPES = ["gp2", "gp3", "sc1", "st1", "standard"]
+
+_SnapshotGroup = namedtuple("_SnapshotGroup", [
+  "instance_name",
+  "datetime",
+  "backup_type",
+  "primary_device",  # such as md0, or the device itself without RAID
+  "snapshots"  # in Backup-Device order
+])
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Restores a group of backup.py snapshots to an instance.")
+  parser.add_argument("--instance-name",
+                      help="the Backup-Instance-Name of the snapshots, "
+                           "instead of prompting for it")
+  parser.add_argument("--datetime",
+                      help="the Backup-Datetime of the snapshots, such as "
+                           "\"2014y-05m-01d 04h00m\", instead of prompting "
+                           "for it")
+  parser.add_argument("--warm", action="store_true",
+                      help="reads every restored volume in full once "
+                           "mounted, so later reads don't wait on S3")
+  options = parser.parse_args()
+
+  connection = common.connect()
+
+  group = _prompt_group(_get_snapshot_groups(connection),
+                        options.instance_name, options.datetime)
+  print("Restoring {} {} {} from {}".format(
+    group.instance_name, group.primary_device, group.datetime,
+    ", ".join(snapshot.id for snapshot in group.snapshots)))
+
+  instance = common.prompt_instance(connection,
+                                    "Which instance to restore to")
+  if not instance:
+    sys.exit("Instance not found.")
+
+  key_path = common.get_pem(instance)
+  print("Using key: {}".format(key_path))
+
+  env.host_string = instance.public_dns_name
+  env.key_filename = key_path
+  env.user = _USERNAME
+
+  volume_type = common.prompt_choice("Volume type", _VOLUME_TYPES,
+                                     _DEFAULT_VOLUME_TYPE)
+
+  common.wait_until_remote_reachable()
+
+  used_devices = common.get_used_device_paths(instance)
+  prefix_device_path = common.prompt_device_prefix(used_devices)
+  device_paths = _create_volumes(
+    connection, instance, group, volume_type,
+    [prefix_device_path + str(index + 1)
+     for index in range(len(group.snapshots))])
+
+  raid_device_path = None
+  if _is_raid(group):
+    raid_device_path = _prompt_raid_device(group, used_devices)
+
+  print("Where do you want the restored directory to be? [Default: {}]"
+        .format(_DEFAULT_DIRECTORY_PATH))
+  directory_path = raw_input() or _DEFAULT_DIRECTORY_PATH
+
+  common.run_steps("restore", _get_restore_commands(
+    device_paths, raid_device_path, directory_path))
+
+  if options.warm:
+    _warm(device_paths)
+
+
+def _create_volumes(connection, instance, group, volume_type, device_paths):
+  """Creates a volume of volume_type from each snapshot in group and
+  attaches them to instance at the matching paths in device_paths, in
+  Backup-Device order. The volumes are all created before any is waited
+  on. Returns the device paths they showed up at on the host."""
+  volume_ids = []
+
+  for snapshot, device_path in zip(group.snapshots, device_paths):
+    volume_name = "{}-restore-{}".format(
+      instance.tags.get("Name"), device_path.replace("/dev/", ""))
+    volume_id = common.call_ec2_api(connection, "CreateVolume", {
+      'AvailabilityZone': instance.placement,
+      'SnapshotId': snapshot.id,
+      'TagSpecification.1.ResourceType': "volume",
+      'TagSpecification.1.Tag.1.Key': "Name",
+      'TagSpecification.1.Tag.1.Value': volume_name,
+      'VolumeType': volume_type
+    }).findtext("volumeId")
+    print("Created EBS volume {} ({}) from {} ({})".format(
+      volume_id, volume_name, snapshot.id, snapshot.tags['Backup-Device']))
+    volume_ids.append(volume_id)
+
+  return common.attach_volumes(connection, instance.id, volume_ids,
+                               device_paths, _ATTACH_TIMEOUT)
+
+
+def _datetime_sort_key(group):
+  """Returns a key that sorts groups by their Backup-Datetime, oldest first,
+  with any in another format before all of them."""
+  try:
+    return datetime.datetime.strptime(group.datetime, _DATETIME_FORMAT)
+  except (TypeError, ValueError):
+    return datetime.datetime.min
+
+
+def _device_sort_key(device_path):
+  """Returns a key that sorts device paths such as /dev/sdf2 before
+  /dev/sdf10."""
+  match = re.match(r"(.*?)(\d*)$", device_path)
+  return (match.group(1), int(match.group(2) or 0))
+
+
+def _get_restore_commands(device_paths, raid_device_path, directory_path):
+  """Returns the commands that assemble the array at raid_device_path from
+  device_paths, unless it's None and the single device holds the file
+  system itself, and mount it at directory_path. XFS file systems are
+  mounted with nouuid, since the original may be mounted on the same
+  host."""
+  commands = []
+  mount_device_path = device_paths[0]
+
+  if raid_device_path:
+    mount_device_path = raid_device_path
+    commands += [
+      "yum install mdadm --assumeyes",
+      "mdadm --detail {0} > /dev/null 2>&1 || mdadm --assemble {0} {1}"
+      .format(raid_device_path, " ".join(device_paths))
+    ]
+
+  return commands + [
+    "mkdir -p {}".format(directory_path),
+    "mountpoint -q {0} || mount $([ \"$(blkid -o value -s TYPE {1})\" = xfs ] "
+    "&& echo -o nouuid) {1} {0}".format(directory_path, mount_device_path)
+  ]
+
+
+def _get_snapshot_groups(connection):
+  """Returns the _SnapshotGroups of the snapshots backup.py took, leaving
+  out groups with any snapshot that hasn't completed. A group is the
+  snapshots of the members of one mount taken in the same backup, told
+  apart by the primary_device in their description. Snapshots without a
+  Backup-Device tag, such as hand-tagged ones, are skipped."""
+  groups = {}
+
+  snapshots = connection.get_all_snapshots(
+    owner="self", filters={'tag-key': "Backup-Datetime"})
+  for snapshot in snapshots:
+    if "Backup-Device" not in snapshot.tags:
+      continue
+    primary_device = re.search(r"primary_device=(\S+)", snapshot.description)
+    key = (snapshot.tags.get("Backup-Instance-Name"),
+           snapshot.tags.get("Backup-Datetime"),
+           snapshot.tags.get("Backup-Type"),
+           primary_device.group(1) if primary_device else None)
+    groups.setdefault(key, []).append(snapshot)
+
+  return [_SnapshotGroup(*(key + (sorted(
+            members, key=lambda snapshot: _device_sort_key(
+              snapshot.tags['Backup-Device'])),)))
+          for key, members in groups.iteritems()
+          if all(snapshot.status == "completed" for snapshot in members)]
+
+
+def _is_raid(group):
+  """Returns whether group holds the members of a RAID array, rather than a
+  single volume's file system."""
+  device = group.snapshots[0].tags['Backup-Device'].replace("/dev/", "")
+  return len(group.snapshots) > 1 or group.primary_device != device
+
+
+def _prompt_group(groups, instance_name=None, snap_datetime=None):
+  """Prompts for one of groups, defaulting to the newest, after narrowing
+  them down to instance_name and snap_datetime where given."""
+  if instance_name:
+    groups = [group for group in groups
+              if group.instance_name == instance_name]
+  if snap_datetime:
+    groups = [group for group in groups if group.datetime == snap_datetime]
+
+  if not groups:
+    sys.exit("No completed backup snapshots found.")
+  if len(groups) == 1:
+    return groups[0]
+
+  choices = [("{} {} {} {} ({} snapshots)".format(
+               group.datetime, group.instance_name, group.backup_type,
+               group.primary_device, len(group.snapshots)), group)
+             for group in groups]
+  newest = max(choices, key=lambda choice: _datetime_sort_key(choice[1]))
+
+  return common.prompt_choice("Which backup to restore", choices, newest[0])
+
+
+def _prompt_raid_device(group, used_devices):
+  """Prompts for the device path the restored array is assembled at,
+  defaulting to the one it was backed up from if it's free."""
+  possible_devices_for_raid = [
+    "/dev/md" + str(index) for index in range(10)
+    if "/dev/md" + str(index) not in used_devices]
+
+  original_device = "/dev/{}".format(group.primary_device)
+  default = (original_device
+             if original_device in possible_devices_for_raid[:5]
+             else possible_devices_for_raid[0])
+
+  return common.prompt_choice("The RAID should be assembled at which device "
+                              "path", possible_devices_for_raid[:5], default)
+
+
+def _warm(device_paths):
+  """Reads each of device_paths in full at the same time, so every block is
+  loaded from its snapshot, and prints how fast that went."""
+  with hide("running", "stdout"):
+    sizes = sudo("blockdev --getsize64 {}".format(" ".join(device_paths)))
+
+  total_size = sum(int(size) for size in sizes.split())
+  results = common.run_steps("warm volumes", [
+    "pids=; for device in {}; do dd if=$device of=/dev/null bs=1M "
+    "iflag=direct 2> /dev/null & pids=\"$pids $!\"; done; "
+    "for pid in $pids; do wait $pid || exit 1; done".format(
+      " ".join(device_paths))
+  ])
+  seconds = results[0][2]
+
+  print("Read {} MiB from {} volumes in {:.0f} seconds, {:.1f} MiB/s".format(
+    total_size // _MEBIBYTE, len(device_paths), seconds,
+    float(total_size) / _MEBIBYTE / max(seconds, 1)))
+
+
+if __name__ == "__main__":
+  main()
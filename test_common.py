@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Offline checks for common.py. Step scripts are run with the local bash
+# through common.run_script_locally instead of on a remote host. Run with
+# "python -m unittest discover" from this directory.
+#
+# NO WARRANTY
+#
+# THE PROGRAM IS DISTRIBUTED IN THE HOPE THAT IT WILL BE USEFUL, BUT WITHOUT ANY WARRANTY. IT IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS WITH YOU. SHOULD THE PROGRAM PROVE DEFECTIVE, YOU ASSUME THE COST OF ALL NECESSARY SERVICING, REPAIR OR CORRECTION.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW THE AUTHOR WILL BE LIABLE TO YOU FOR DAMAGES, INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING OUT OF THE USE OR INABILITY TO USE THE PROGRAM (INCLUDING BUT NOT LIMITED TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER PROGRAMS), EVEN IF THE AUTHOR HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+
+# Standard Modules
+import imp
+import unittest
+
+# Local Modules
+import common
+
+
+def _has_module(name):
+  """Returns whether the module called name can be imported."""
+  try:
+    imp.find_module(name)
+    return True
+  except ImportError:
+    return False
+
+
+class RunStepsTest(unittest.TestCase):
+
+  def run_steps(self, commands):
+    return common.run_steps("test", commands, common.run_script_locally)
+
+  def test_all_steps_succeed(self):
+    commands = ["true", "echo output", "true"]
+    results = self.run_steps(commands)
+
+    self.assertEqual([command for command, _, _ in results], commands)
+    self.assertEqual([status for _, status, _ in results], [0, 0, 0])
+
+  def test_output_without_trailing_newline(self):
+    results = self.run_steps(["printf no-newline", "true"])
+
+    self.assertEqual([status for _, status, _ in results], [0, 0])
+
+  def test_no_steps(self):
+    self.assertEqual(self.run_steps([]), [])
+
+  @unittest.skipUnless(_has_module("fabric"), "needs fabric")
+  def test_failed_step_is_blamed(self):
+    with self.assertRaises(SystemExit) as context:
+      self.run_steps(["true", "exit 3", "true"])
+
+    self.assertIn("failed at: exit 3", str(context.exception))
+
+  @unittest.skipUnless(_has_module("fabric"), "needs fabric")
+  def test_step_cut_off_is_blamed(self):
+    with self.assertRaises(SystemExit) as context:
+      self.run_steps(["true", "kill -9 $$", "true"])
+
+    self.assertIn("failed at: kill -9 $$", str(context.exception))
+
+
+class ParseStepOutputTest(unittest.TestCase):
+
+  def test_ignores_other_output(self):
+    commands = ["echo a", "echo b"]
+    output = common.run_script_locally(
+      "test", common.render_steps_script("test", commands))
+    results = common.parse_step_output(commands, output)
+
+    self.assertEqual([(command, status) for command, status, _ in results],
+                     [("echo a", 0), ("echo b", 0)])
+
+
+
+class WaitForTest(unittest.TestCase):
+
+  def test_returns_the_check_result(self):
+    self.assertEqual(common.wait_for(lambda: "ready", "test", 0), "ready")
+
+  def test_timeout_raises(self):
+    with self.assertRaises(common.WaitTimeout) as context:
+      common.wait_for(lambda: False, "test", 0)
+
+    self.assertIn("waiting for test", str(context.exception))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#
+# Offline checks for grab_bag.py. Each subcommand's module is imported in a
+# fresh interpreter, as "grab_bag.py --import-times" does, and must neither
+# load a library it shouldn't need until it runs nor take longer than
+# grab_bag._IMPORT_TIME_LIMIT. Run with "python -m unittest discover" from
+# this directory.
+#
+# NO WARRANTY
+#
+# THE PROGRAM IS DISTRIBUTED IN THE HOPE THAT IT WILL BE USEFUL, BUT WITHOUT ANY WARRANTY. IT IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESSED OR IMPLIED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. THE ENTIRE RISK AS TO THE QUALITY AND PERFORMANCE OF THE PROGRAM IS WITH YOU. SHOULD THE PROGRAM PROVE DEFECTIVE, YOU ASSUME THE COST OF ALL NECESSARY SERVICING, REPAIR OR CORRECTION.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW THE AUTHOR WILL BE LIABLE TO YOU FOR DAMAGES, INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING OUT OF THE USE OR INABILITY TO USE THE PROGRAM (INCLUDING BUT NOT LIMITED TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER PROGRAMS), EVEN IF THE AUTHOR HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES.
+
+# Standard Modules
+import imp
+import unittest
+
+# Local Modules
+import grab_bag
+
+
+def _has_module(name):
+  """Returns whether the module called name can be imported."""
+  try:
+    imp.find_module(name)
+    return True
+  except ImportError:
+    return False
+
+
+@unittest.skipUnless(_has_module("boto") and _has_module("fabric"),
+                     "needs boto and fabric")
+class ImportTimesTest(unittest.TestCase):
+
+  def test_subcommands_import_quickly_and_lightly(self):
+    for name, subcommand in sorted(grab_bag._SUBCOMMANDS.iteritems()):
+      seconds, loaded = grab_bag._time_import(subcommand.module)
+
+      self.assertEqual(
+        grab_bag._get_import_problems(subcommand, seconds, loaded), [], name)
+
+
+class ImportProblemsTest(unittest.TestCase):
+
+  def test_unused_library_loaded(self):
+    subcommand = grab_bag._Subcommand("backup", ["boto", "fabric"])
+
+    self.assertEqual(grab_bag._get_import_problems(subcommand, 0, ["boto"]),
+                     ["should not load boto"])
+
+  def test_too_slow(self):
+    subcommand = grab_bag._Subcommand("create_instance", [])
+    seconds = grab_bag._IMPORT_TIME_LIMIT + 1
+
+    self.assertEqual(
+      grab_bag._get_import_problems(subcommand, seconds, ["boto", "fabric"]),
+      ["slower than {}s".format(grab_bag._IMPORT_TIME_LIMIT)])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -10,35 +10,207 @@ from __future__ import print_function
 
 # Standard Modules
 from collections import namedtuple
+import argparse
+import datetime
+import fnmatch
+import heapq
+import json
+import sys
+import time
+
+# Third-Party Modules
+from boto.exception import BotoServerError
 
 # Local Modules
 import common
 
 
+_BATCH_ATTEMPTS = 5
+_BATCH_BACKOFF = 2  # seconds, doubled after every failed attempt
+_BATCH_MODES = ["sync", "add", "remove", "rotate", "rebalance"]
+_BATCH_SIZE = 20
 _DEFAULT_ELB_NAME = "default-elb-name-goes-here"
 _DEFAULT_ELB_ACTION = "Show Info"
+_DEFAULT_REGION = "us-east-1"
+_DEFAULT_ROTATION_BATCH_SIZE = 2
+_DEFAULT_ROTATION_BATCH_TIMEOUT = 600  # seconds
+_DEFAULT_ROTATION_DRAIN = 30  # seconds
+_DEFAULT_ROTATION_IN_FLIGHT = 1
+_DEFAULT_ROTATION_MIN_HEALTHY = 75  # percent
 _ELB_ACTIONS = ["Show Info",
                 "Add Instance",
                 "Remove Instance",
+                "Rebalance Zones",
                 #"Check Instance",
                 "Exit"
 ]
 
-_ELBInfo = namedtuple("_ELBInfo", [
-  "zones",
-  "registered_instances",
-  "unregistered_instances"
-])
+_MONITOR_CALL_SPACING = 0.2  # seconds between any two health calls
+_MONITOR_MAX_INTERVAL = 60  # seconds
+_MONITOR_MIN_INTERVAL = 5  # seconds
+_ROTATION_POLL_INTERVAL = 5  # seconds
 
 _InstanceInfo = namedtuple("_InstanceInfo", [
   "name",
   "id",
   "status",
-  "zone"
+  "zone",
+  "tags"
 ])
 
 
+class _ELBInfo(object):
+  """Holds what is known about an ELB's zones and members. Member ids are
+  kept in a set and instance details in a dict keyed by instance id, so
+  membership checks don't scan lists. Only the registered instances are
+  fetched up front; the unregistered candidates are listed the first time
+  they're asked for after each refresh. Registering or deregistering
+  through this object updates the membership in place instead of relisting
+  everything."""
+
+  def __init__(self, ec2_connection, elb):
+    self.ec2_connection = ec2_connection
+    self.elb = elb
+    self.registered_ids = set()
+    self._instances = {}
+    self._listed_all_instances = False
+    self._zone_states = {zone.name: zone.state for zone
+                         in ec2_connection.get_all_zones(
+                           elb.availability_zones)}
+    self.refresh()
+
+  @property
+  def registered_instances(self):
+    """The sorted _InstanceInfos of the registered instances."""
+    return sorted(self._instances[instance_id] for instance_id
+                  in self.registered_ids if instance_id in self._instances)
+
+  @property
+  def unregistered_instances(self):
+    """The sorted _InstanceInfos of every instance not registered with the
+    ELB. All instances are listed the first time this is used after a
+    refresh."""
+    if not self._listed_all_instances:
+      self._fetch_instances()
+      self._listed_all_instances = True
+
+    return sorted(info for instance_id, info in self._instances.iteritems()
+                  if instance_id not in self.registered_ids)
+
+  @property
+  def zones(self):
+    """A dict of zone name to its instance count and status."""
+    elb_zones = {name: {"instance_count": 0, "status": state}
+                 for name, state in self._zone_states.iteritems()}
+
+    for info in self.registered_instances:
+      if info.zone in elb_zones:
+        elb_zones[info.zone]["instance_count"] += 1
+
+    return elb_zones
+
+  def deregister(self, instance_ids):
+    """Deregisters instance_ids from the ELB."""
+    self.elb.deregister_instances(instance_ids)
+    self.registered_ids.difference_update(instance_ids)
+
+  def refresh(self):
+    """Re-reads the ELB membership, fetching details only for members that
+    haven't been seen yet. The other instances are forgotten, so instances
+    launched since, and their current states, show up when they're next
+    asked for."""
+    health = self.elb.connection.describe_instance_health(self.elb.name)
+    self.registered_ids = set(instance.instance_id for instance in health)
+    self._instances = {instance_id: info for instance_id, info
+                       in self._instances.iteritems()
+                       if instance_id in self.registered_ids}
+    self._listed_all_instances = False
+    self._fetch_instances(self.registered_ids.difference(self._instances))
+
+    for info in self.registered_instances:
+      if info.zone not in self._zone_states:
+        print("""*** Warning! ELB has an out-of-zone instance.
+***   Instance name: {}
+***   Instance zone: {}""".format(info.name, info.zone), file=sys.stderr)
+
+  def register(self, instance_ids):
+    """Registers instance_ids with the ELB."""
+    self.elb.register_instances(instance_ids)
+    self.registered_ids.update(instance_ids)
+
+  def _fetch_instances(self, instance_ids=None):
+    """Fetches and caches the instances in instance_ids, or every instance
+    if instance_ids is None."""
+    if instance_ids is None:
+      reservations = self.ec2_connection.get_all_instances()
+    elif instance_ids:
+      reservations = self.ec2_connection.get_all_instances(
+        filters={"instance-id": list(instance_ids)})
+    else:
+      return
+
+    for reservation in reservations:
+      for instance in reservation.instances:
+        self._instances[instance.id] = _InstanceInfo(
+          instance.tags.get("Name"), instance.id, instance.state,
+          instance.placement, instance.tags)
+
+
 def main():
+  parser = argparse.ArgumentParser(
+    description="Shows and updates the instances registered with an ELB. "
+                "Runs interactively unless --elb is given.")
+  parser.add_argument("--elb", help="name of the ELB to update in batch mode")
+  parser.add_argument("--region", default=_DEFAULT_REGION,
+                      help="region of the ELB in batch mode (default "
+                           "%(default)s)")
+  parser.add_argument("--select", action="append", default=[],
+                      metavar="TAG=PATTERN",
+                      help="selects instances whose tag matches the glob "
+                           "pattern, such as Name=web-*; may be repeated")
+  parser.add_argument("--mode", choices=_BATCH_MODES, default="sync",
+                      help="sync makes the selected instances the only "
+                           "members, add registers them, remove "
+                           "deregisters them, rotate replaces the "
+                           "unselected members with the selected instances "
+                           "batch by batch and rebalance evens out the "
+                           "members across zones (default %(default)s)")
+  parser.add_argument("--dry-run", action="store_true",
+                      help="prints the diff without changing the ELB")
+  parser.add_argument("--batch-size", type=common.positive_int,
+                      default=_DEFAULT_ROTATION_BATCH_SIZE,
+                      help="instances swapped per rotation batch (default "
+                           "%(default)s)")
+  parser.add_argument("--max-in-flight", type=common.positive_int,
+                      default=_DEFAULT_ROTATION_IN_FLIGHT,
+                      help="rotation batches in progress at once (default "
+                           "%(default)s)")
+  parser.add_argument("--drain-seconds", type=int,
+                      default=_DEFAULT_ROTATION_DRAIN,
+                      help="seconds to let connections drain after "
+                           "deregistering a batch (default %(default)s)")
+  parser.add_argument("--batch-timeout", type=int,
+                      default=_DEFAULT_ROTATION_BATCH_TIMEOUT,
+                      help="seconds a batch's replacements have to reach "
+                           "InService (default %(default)s)")
+  parser.add_argument("--min-healthy-percent", type=int,
+                      default=_DEFAULT_ROTATION_MIN_HEALTHY,
+                      help="stops the rotation if fewer of the settled "
+                           "members are InService (default %(default)s)")
+  parser.add_argument("--monitor", action="append", default=[],
+                      metavar="ELB",
+                      help="watches the ELB's instance health and prints "
+                           "each transition as a JSON line; may be repeated")
+  arguments = parser.parse_args()
+
+  if arguments.monitor:
+    _monitor(common.connect_elb_region(arguments.region), arguments.monitor)
+    return
+
+  if arguments.elb:
+    _run_batch(arguments)
+    return
+
   ec2_connection = common.connect()
   region = common.prompt_region(ec2_connection)
   elb_connection = common.connect_elb_region(region.name)
@@ -48,74 +220,269 @@ def main():
     print("No ELBs exist for region {}".format(region.name))
     return
 
+  elb_info = _ELBInfo(ec2_connection, elb)
   choice = common.prompt_choice("Choice", _ELB_ACTIONS, _DEFAULT_ELB_ACTION)
   while (choice != "Exit"):
-    elb_info = _get_elb_info(ec2_connection, elb)
-    _handle_user_choice(choice, elb, elb_info.zones,
-                        elb_info.registered_instances,
-                        elb_info.unregistered_instances)
+    _handle_user_choice(choice, elb_info)
     choice = common.prompt_choice("Choice", _ELB_ACTIONS, _DEFAULT_ELB_ACTION)
   return
 
 
-def _add_instance(elb, elb_zones, unregistered_instances):
+def _add_instance(elb_info):
   """Prompts the user for an instance to add, then adds that instance
   to an ELB."""
-  _pretty_print_elb_zones(elb, elb_zones)
-  _pretty_print_elb_instances(elb, unregistered_instances, False)
+  unregistered_instances = elb_info.unregistered_instances
+  _pretty_print_elb_zones(elb_info.elb, elb_info.zones)
+  _pretty_print_elb_instances(elb_info.elb, unregistered_instances, False)
 
   unreg_instances = [(inst.name, inst) for inst in unregistered_instances]
   instance_to_add = common.prompt_choice("Add", unreg_instances)
   if common.prompt_confirmation("Are you sure you want to add {}".format(
     instance_to_add.name)):
-    elb.register_instances([instance_to_add.id])
+    elb_info.register([instance_to_add.id])
     print("Instance added to ELB.")
   else:
     print("Instance was NOT added to ELB.")
 
 
-def _get_elb_info(ec2_connection, elb):
-  """Gets general info about the ELB and returns an
-  _ELBInfo namedtuple."""
-  zones = ec2_connection.get_all_zones(elb.availability_zones)
-  elb_zones = {zone.name: {'instance_count': 0, 'status': zone.state}
-               for zone in zones}
-
-  registered_instances = []
-  unregistered_instances = []
-  elb_instances = elb.connection.describe_instance_health(elb.name)
-  elb_instance_ids = [instance.instance_id for instance in elb_instances]
-  reservations = ec2_connection.get_all_instances()
-  for reservation in reservations:
-    for instance in reservation.instances:
-      inst_info = _InstanceInfo(instance.tags.get("Name"), instance.id,
-                                instance.state, instance.placement)
-      if inst_info.id in elb_instance_ids:
-        registered_instances.append(inst_info)
-        if inst_info.zone in elb_zones:
-          elb_zones[inst_info.zone]["instance_count"] += 1
-        else:
-          print("""*** Warning! ELB has an out-of-zone instance.
-***   Instance name: {}
-***   Instance zone: {}""".format(inst_info.name, inst_info.zone))
-      else:
-        unregistered_instances.append(inst_info)
+def _call_in_batches(method, instance_ids):
+  """Calls method, such as elb.register_instances, with instance_ids split
+  into chunks of _BATCH_SIZE. Throttled or failed calls are retried with
+  exponential backoff."""
+  for start in range(0, len(instance_ids), _BATCH_SIZE):
+    batch = instance_ids[start:start + _BATCH_SIZE]
+    delay = _BATCH_BACKOFF
+
+    for attempt in range(1, _BATCH_ATTEMPTS + 1):
+      try:
+        method(batch)
+        break
+      except BotoServerError as err:
+        if attempt == _BATCH_ATTEMPTS:
+          raise
+        print("{} failed ({}), sleeping {} seconds (attempt={})".format(
+          method.__name__, err.error_code, delay, attempt), file=sys.stderr)
+        time.sleep(delay)
+        delay *= 2
+
+
+def _compute_batch_diff(elb_info, selectors, mode):
+  """Returns the (to_register, to_deregister) lists of _InstanceInfo needed
+  to bring the ELB membership in line with selectors under mode."""
+  selected_registered = [inst for inst in elb_info.registered_instances
+                         if _matches_selectors(inst, selectors)]
+  selected_unregistered = [inst for inst in elb_info.unregistered_instances
+                           if _matches_selectors(inst, selectors)
+                           and inst.status == "running"]
+
+  if mode == "add":
+    return selected_unregistered, []
+  elif mode == "remove":
+    return [], selected_registered
+  else:
+    unselected_registered = [inst for inst in elb_info.registered_instances
+                             if not _matches_selectors(inst, selectors)]
+    return selected_unregistered, unselected_registered
 
-  registered_instances = sorted(registered_instances)
-  unregistered_instances = sorted(unregistered_instances)
-  return _ELBInfo(elb_zones, registered_instances, unregistered_instances)
 
+def _handle_user_choice(choice, elb_info):
+  """Handles the user choice in the main read-eval-print loop. The ELB's
+  state is refreshed first, so each choice sees current instances."""
+  elb_info.refresh()
 
-def _handle_user_choice(choice, elb, elb_zones,
-                        registered_instances, unregistered_instances):
-  """Handles the user choice in the main read-eval-print loop."""
   if choice == "Show Info":
-    _show_info(elb, elb_zones, registered_instances,
-                      unregistered_instances)
+    _show_info(elb_info)
   elif choice == "Remove Instance":
-    _remove_instance(elb, registered_instances)
+    _remove_instance(elb_info)
   elif choice == "Add Instance":
-    _add_instance(elb, elb_zones, unregistered_instances)
+    _add_instance(elb_info)
+  elif choice == "Rebalance Zones":
+    _rebalance_zones(elb_info)
+
+
+def _healthy_percent(states, pending_ids):
+  """Returns the percentage of settled members, those not waiting to come
+  into service as part of a rotation batch, that are InService."""
+  settled = [state for instance_id, state in states.iteritems()
+             if instance_id not in pending_ids]
+  if not settled:
+    return 100
+
+  in_service = [state for state in settled if state == "InService"]
+  return 100 * len(in_service) // len(settled)
+
+
+def _matches_selectors(instance_info, selectors):
+  """Returns whether the instance's tags match every (tag, pattern) pair in
+  selectors."""
+  for tag, pattern in selectors:
+    value = instance_info.tags.get(tag)
+    if value is None or not fnmatch.fnmatchcase(value, pattern):
+      return False
+
+  return True
+
+
+def _monitor(elb_connection, elb_names):
+  """Polls the instance health of every ELB in elb_names and prints each
+  state transition to stdout as a JSON line, redrawing a table of the
+  current states on stderr when it's a terminal. Each ELB is polled on its
+  own schedule: the interval doubles while its health is unchanged, up to
+  _MONITOR_MAX_INTERVAL, drops back to _MONITOR_MIN_INTERVAL after a change
+  and jumps to _MONITOR_MAX_INTERVAL after an error. Calls are spaced at
+  least _MONITOR_CALL_SPACING apart so that many ELBs can be watched without
+  being throttled."""
+  states = {name: None for name in elb_names}
+  intervals = {name: _MONITOR_MIN_INTERVAL for name in elb_names}
+  schedule = [(0, name) for name in elb_names]
+  last_call = 0
+
+  try:
+    while True:
+      due, name = heapq.heappop(schedule)
+      time.sleep(max(0, due - time.time(),
+                     last_call + _MONITOR_CALL_SPACING - time.time()))
+      last_call = time.time()
+
+      try:
+        health = elb_connection.describe_instance_health(name)
+      except BotoServerError as err:
+        print("Could not poll {} ({})".format(name, err.error_code),
+              file=sys.stderr)
+        intervals[name] = _MONITOR_MAX_INTERVAL
+        heapq.heappush(schedule, (time.time() + intervals[name], name))
+        continue
+
+      timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+      current = {instance.instance_id: instance for instance in health}
+      changed = False
+
+      if states[name] is None:
+        states[name] = {instance_id: (instance.state, timestamp)
+                        for instance_id, instance in current.iteritems()}
+        changed = True
+      else:
+        for instance_id in sorted(set(states[name]) | set(current)):
+          previous = states[name].get(instance_id, (None, None))[0]
+          instance = current.get(instance_id)
+          state = instance.state if instance else None
+          if state == previous:
+            continue
+
+          print(json.dumps({
+            "time": timestamp,
+            "elb": name,
+            "instance_id": instance_id,
+            "from": previous,
+            "to": state,
+            "reason_code": instance.reason_code if instance else None,
+            "description": instance.description if instance else None
+          }, sort_keys=True))
+          if state:
+            states[name][instance_id] = (state, timestamp)
+          else:
+            del states[name][instance_id]
+          changed = True
+
+      if changed:
+        intervals[name] = _MONITOR_MIN_INTERVAL
+        sys.stdout.flush()
+        if sys.stderr.isatty():
+          _print_monitor_table(states)
+      else:
+        intervals[name] = min(intervals[name] * 2, _MONITOR_MAX_INTERVAL)
+
+      heapq.heappush(schedule, (time.time() + intervals[name], name))
+  except KeyboardInterrupt:
+    print("Stopped monitoring", file=sys.stderr)
+
+
+def _parse_selectors(selector_strings):
+  """Parses TAG=PATTERN strings into a list of (tag, pattern) tuples."""
+  selectors = []
+
+  for selector_string in selector_strings:
+    if "=" not in selector_string:
+      sys.exit("Invalid selector {}, expected TAG=PATTERN".format(
+        selector_string))
+    tag, pattern = selector_string.split("=", 1)
+    selectors.append((tag, pattern))
+
+  return selectors
+
+
+def _plan_rebalance(elb_info, selectors):
+  """Returns the (to_register, to_deregister) lists of _InstanceInfo that
+  even out the members across the ELB's available zones with the fewest
+  moves. Under-served zones are topped up from running, unregistered
+  instances in that zone that match selectors, and over-served zones give
+  up at most as many members as were added, so capacity never drops."""
+  zones = elb_info.zones
+  usable_zones = sorted(name for name in zones
+                        if zones[name]["status"] == "available")
+  if not usable_zones:
+    return [], []
+
+  members = {name: [] for name in usable_zones}
+  for inst in elb_info.registered_instances:
+    if inst.zone in members:
+      members[inst.zone].append(inst)
+
+  candidates = {name: [] for name in usable_zones}
+  for inst in elb_info.unregistered_instances:
+    if (inst.zone in candidates and inst.status == "running" and
+        _matches_selectors(inst, selectors)):
+      candidates[inst.zone].append(inst)
+
+  # The most loaded zones keep the leftover slots, which saves moves.
+  ranked_zones = sorted(usable_zones, key=lambda name: -len(members[name]))
+  total = sum(len(zone_members) for zone_members in members.itervalues())
+  base, extra = divmod(total, len(usable_zones))
+  targets = {name: base + (1 if index < extra else 0)
+             for index, name in enumerate(ranked_zones)}
+
+  to_register = []
+  for name in usable_zones:
+    deficit = targets[name] - len(members[name])
+    if deficit > 0:
+      to_register.extend(candidates[name][:deficit])
+
+  to_deregister = []
+  budget = len(to_register)
+  for name in ranked_zones:
+    surplus = min(len(members[name]) - targets[name], budget)
+    if surplus > 0:
+      to_deregister.extend(members[name][-surplus:])
+      budget -= surplus
+
+  return to_register, to_deregister
+
+
+def _plan_rotation_batches(retiring_ids, replacement_ids, batch_size):
+  """Pairs up retiring and replacement instance ids into rotation batches of
+  at most batch_size of each."""
+  batches = []
+  count = max(len(retiring_ids), len(replacement_ids))
+
+  for start in range(0, count, batch_size):
+    batches.append({
+      "deregister": retiring_ids[start:start + batch_size],
+      "register": replacement_ids[start:start + batch_size],
+      "phase": "queued"
+    })
+
+  return batches
+
+
+def _print_monitor_table(states):
+  """Redraws the table of the monitored instance states on stderr."""
+  template = "{:24} {:16} {:14} {:20}"
+  sys.stderr.write("\033[2J\033[H")
+  print(template.format("ELB", "INSTANCE", "STATE", "SINCE"), file=sys.stderr)
+
+  for name in sorted(states):
+    for instance_id, (state, since) in sorted((states[name] or {}).items()):
+      print(template.format(name, instance_id, state, since), file=sys.stderr)
 
 
 def _pretty_print_elb_zones(elb, elb_zones):
@@ -148,10 +515,48 @@ def _pretty_print_elb_instances(elb, instances, are_registered):
   print()
 
 
-def _remove_instance(elb, registered_instances):
+def _project_zones(zone_counts, to_register, to_deregister):
+  """Returns zone_counts, a dict of zone name to instance count, as it would
+  be after registering the _InstanceInfos in to_register and deregistering
+  the ones in to_deregister."""
+  projected = dict(zone_counts)
+  for info in to_register:
+    if info.zone in projected:
+      projected[info.zone] += 1
+  for info in to_deregister:
+    if info.zone in projected:
+      projected[info.zone] -= 1
+
+  return projected
+
+
+def _rebalance_zones(elb_info):
+  """Shows the zone rebalancing plan for the ELB and applies it if the user
+  confirms."""
+  _pretty_print_elb_zones(elb_info.elb, elb_info.zones)
+  to_register, to_deregister = _plan_rebalance(elb_info, [])
+
+  if not to_register:
+    print("No moves would improve the zone balance.")
+    return
+
+  _pretty_print_elb_instances(elb_info.elb, to_register, False)
+  _pretty_print_elb_instances(elb_info.elb, to_deregister, True)
+  if common.prompt_confirmation("Register {} and deregister {}".format(
+    len(to_register), len(to_deregister))):
+    _call_in_batches(elb_info.register, [inst.id for inst in to_register])
+    _call_in_batches(elb_info.deregister,
+                     [inst.id for inst in to_deregister])
+    _pretty_print_elb_zones(elb_info.elb, elb_info.zones)
+  else:
+    print("ELB was NOT rebalanced.")
+
+
+def _remove_instance(elb_info):
   """Prompts the user for an instance to remove from the ELB, then removes
   it. Asks for a confirmation before actually removing it."""
-  _pretty_print_elb_instances(elb, registered_instances, True)
+  registered_instances = elb_info.registered_instances
+  _pretty_print_elb_instances(elb_info.elb, registered_instances, True)
 
   reg_instances = [(inst.name, inst) for inst in registered_instances]
   if len(reg_instances) == 0:
@@ -161,20 +566,138 @@ def _remove_instance(elb, registered_instances):
   instance_to_remove = common.prompt_choice("Remove", reg_instances)
   if common.prompt_confirmation("Are you sure you want to remove {}".format(
     instance_to_remove.name)):
-    elb.deregister_instances([instance_to_remove.id])
+    elb_info.deregister([instance_to_remove.id])
     print("Instance removed from ELB.")
   else:
     print("Instance was NOT removed from ELB.")
 
 
-def _show_info(elb, elb_zones, registered_hosts, unregistered_hosts):
+def _rotate(elb_info, batches, arguments):
+  """Runs the rotation batches against the ELB of elb_info. Each batch is
+  deregistered, left to drain for --drain-seconds, then its replacements are
+  registered and it completes once they are all InService. Up to
+  --max-in-flight batches run at once, and every tick polls the health of
+  all members with one describe_instance_health call. Exits if the healthy
+  percentage of the settled members drops below --min-healthy-percent or a
+  batch times out."""
+  elb = elb_info.elb
+  queued = list(batches)
+  in_flight = []
+
+  while queued or in_flight:
+    now = time.time()
+    states = {instance.instance_id: instance.state for instance
+              in elb.connection.describe_instance_health(elb.name)}
+    pending_ids = set()
+    for batch in in_flight:
+      if batch["phase"] == "registering":
+        pending_ids.update(batch["register"])
+
+    healthy_percent = _healthy_percent(states, pending_ids)
+    if healthy_percent < arguments.min_healthy_percent:
+      sys.exit("Stopping rotation: only {}% of settled members are "
+               "InService".format(healthy_percent))
+
+    for batch in list(in_flight):
+      if batch["phase"] == "draining" and now >= batch["drained_at"]:
+        _call_in_batches(elb_info.register, batch["register"])
+        batch["phase"] = "registering"
+        batch["deadline"] = now + arguments.batch_timeout
+      elif batch["phase"] == "registering":
+        if all(states.get(instance_id) == "InService"
+               for instance_id in batch["register"]):
+          batch["phase"] = "done"
+          in_flight.remove(batch)
+          print("Rotated out {} for {}".format(batch["deregister"],
+            batch["register"]), file=sys.stderr)
+        elif now > batch["deadline"]:
+          sys.exit("Stopping rotation: {} did not come into service".format(
+            batch["register"]))
+
+    while queued and len(in_flight) < arguments.max_in_flight:
+      batch = queued.pop(0)
+      _call_in_batches(elb_info.deregister, batch["deregister"])
+      batch["phase"] = "draining"
+      batch["drained_at"] = (now + arguments.drain_seconds
+                             if batch["deregister"] else now)
+      in_flight.append(batch)
+
+    if queued or in_flight:
+      time.sleep(_ROTATION_POLL_INTERVAL)
+
+
+def _run_batch(arguments):
+  """Updates the ELB membership without prompting and prints the resulting
+  diff as JSON."""
+  selectors = _parse_selectors(arguments.select)
+  if not selectors and arguments.mode != "rebalance":
+    sys.exit("Batch mode needs at least one --select")
+
+  ec2_connection = common.connect_region(arguments.region)
+  elb_connection = common.connect_elb_region(arguments.region)
+  elb = elb_connection.get_all_load_balancers(
+    load_balancer_names=[arguments.elb])[0]
+  elb_info = _ELBInfo(ec2_connection, elb)
+
+  zone_counts_before = _summarize_zones(elb_info.zones)
+  if arguments.mode == "rebalance":
+    to_register, to_deregister = _plan_rebalance(elb_info, selectors)
+  else:
+    to_register, to_deregister = _compute_batch_diff(elb_info, selectors,
+                                                     arguments.mode)
+
+  if arguments.mode == "rotate":
+    batches = _plan_rotation_batches([inst.id for inst in to_deregister],
+                                     [inst.id for inst in to_register],
+                                     arguments.batch_size)
+    if not arguments.dry_run:
+      _rotate(elb_info, batches, arguments)
+  elif not arguments.dry_run:
+    _call_in_batches(elb_info.register, [inst.id for inst in to_register])
+    _call_in_batches(elb_info.deregister,
+                     [inst.id for inst in to_deregister])
+
+  if arguments.dry_run:
+    zone_counts_after = _project_zones(zone_counts_before, to_register,
+                                       to_deregister)
+  else:
+    zone_counts_after = _summarize_zones(elb_info.zones)
+
+  print(json.dumps({
+    "elb": elb.name,
+    "mode": arguments.mode,
+    "dry_run": arguments.dry_run,
+    "register": [_summarize_instance(inst) for inst in to_register],
+    "deregister": [_summarize_instance(inst) for inst in to_deregister],
+    "zones_before": zone_counts_before,
+    "zones_after": zone_counts_after
+  }, sort_keys=True))
+
+
+def _show_info(elb_info):
   """Shows general info about the ELB."""
+  elb = elb_info.elb
   print("ELB Info")
   print("ELB Name: {}".format(elb.name))
   print("ELB DNS Name: {}".format(elb.dns_name))
-  _pretty_print_elb_zones(elb, elb_zones)
-  _pretty_print_elb_instances(elb, registered_hosts, True)
-  _pretty_print_elb_instances(elb, unregistered_hosts, False)
+  _pretty_print_elb_zones(elb, elb_info.zones)
+  _pretty_print_elb_instances(elb, elb_info.registered_instances, True)
+  _pretty_print_elb_instances(elb, elb_info.unregistered_instances, False)
+
+
+def _summarize_instance(instance_info):
+  """Returns a JSON-friendly dict describing an _InstanceInfo."""
+  return {
+    "id": instance_info.id,
+    "name": instance_info.name,
+    "zone": instance_info.zone
+  }
+
+
+def _summarize_zones(elb_zones):
+  """Returns a dict of zone name to instance count."""
+  return {name: zone["instance_count"]
+          for name, zone in elb_zones.iteritems()}
 
 
 if __name__ == "__main__":
@@ -14,19 +14,47 @@
 from __future__ import print_function
 
 # Standard Modules
-from StringIO import StringIO
-import re
+import argparse
+import hashlib
+import httplib
+import os
+import stat
 import subprocess
 import tempfile
+import time
+
+# Third-Party Modules
+from boto.exception import EC2ResponseError
 
 # Local Modules
 import common
 
 
+_DEFAULT_WATCH_INTERVAL = 30  # seconds
 _HOSTS_PATH = "/etc/hosts"
+_LIVE_INSTANCE_STATES = [
+  "pending",
+  "running",
+  "shutting-down",
+  "stopping",
+  "stopped"
+]
+_MAX_WATCH_INTERVAL = 300  # seconds
 
 
 def main():
+  parser = argparse.ArgumentParser(
+    description="Updates {} with aliases for your EC2 instances.".format(
+      _HOSTS_PATH))
+  parser.add_argument("--watch", action="store_true",
+                      help="keep running and rewrite the section whenever "
+                           "the instances change")
+  parser.add_argument("--interval", type=common.positive_int,
+                      default=_DEFAULT_WATCH_INTERVAL,
+                      help="seconds between polls in watch mode (default "
+                           "%(default)s)")
+  arguments = parser.parse_args()
+
   connection = common.connect()
 
   prefix = raw_input(
@@ -40,50 +68,196 @@ def main():
   begin_marker = "# {}{} begin".format(prefix, region.name)
   end_marker = "# {}{} end".format(prefix, region.name)
 
-  with open(_HOSTS_PATH) as hosts_file:
-    content = hosts_file.read()
+  connection = common.connect(region)
 
-  content = re.sub("\s*{}.*{}".format(begin_marker, end_marker), "", content,
-                   flags=re.DOTALL)
+  if arguments.watch:
+    _watch(connection, type_ == "public", begin_marker, end_marker,
+           arguments.interval)
+    return
 
-  connection = common.connect(region)
   mapping = sorted(_get_mapping(connection, type_ == "public"))
-  content += _generate_mapping_content(begin_marker, end_marker, mapping)
 
-  with tempfile.NamedTemporaryFile(delete=False) as temporary_file:
-    temporary_file.write(content)
+  if _update_hosts_section(begin_marker, end_marker, mapping):
+    print("Updated {}".format(_HOSTS_PATH))
+  else:
+    print("{} is already up to date".format(_HOSTS_PATH))
+
+
+def _find_section(lines, begin_marker, end_marker):
+  """Scans lines for the section between begin_marker and end_marker and
+  returns the (begin, end) indexes of the marker lines, or None if there is no
+  complete section."""
+  begin = None
 
-  subprocess.check_call([
-    "sudo",
-    "cp",
-    temporary_file.name,
-    _HOSTS_PATH
-  ])
+  for index, line in enumerate(lines):
+    stripped_line = line.strip()
 
+    if begin is None:
+      if stripped_line == begin_marker:
+        begin = index
+    elif stripped_line == end_marker:
+      return begin, index
 
-def _generate_mapping_content(begin_marker, end_marker, mapping):
-  output = StringIO()
-  output.write("\n")
-  output.write(begin_marker)
-  output.write("\n")
+  return None
+
+
+def _generate_section_lines(begin_marker, end_marker, mapping):
+  """Returns the lines of the hosts file section for mapping, including the
+  begin and end markers."""
+  lines = [begin_marker]
 
   for name, ip_address in mapping:
-    output.write("{:15} {}\n".format(ip_address, name))
+    lines.append("{:15} {}".format(ip_address, name))
 
-  output.write(end_marker)
-  output.write("\n")
+  lines.append(end_marker)
 
-  return output.getvalue()
+  return lines
 
 
 def _get_mapping(connection, public):
-  for reservation in connection.get_all_instances():
-    instance = reservation.instances[0]
-    ip_address = instance.ip_address if public else instance.private_ip_address
-    name = instance.tags.get("Name")
+  # Terminated instances never have an address, so leave them out of the
+  # response.
+  filters = {"instance-state-name": _LIVE_INSTANCE_STATES}
+
+  for reservation in connection.get_all_instances(filters=filters):
+    for instance in reservation.instances:
+      ip_address = (instance.ip_address if public else
+                    instance.private_ip_address)
+      name = instance.tags.get("Name")
+
+      if ip_address and name:
+        yield name, ip_address
+
+
+def _hash_mapping(mapping):
+  """Returns a compact digest of a sorted mapping, used to tell whether the
+  instances changed between polls."""
+  return hashlib.sha1(repr(mapping)).hexdigest()
+
+
+def _replace_section(content, begin_marker, end_marker, section_lines):
+  """Returns content with the marked section replaced by section_lines. The
+  section is replaced in place if it exists, otherwise it is appended after a
+  blank line."""
+  lines = content.splitlines()
+  bounds = _find_section(lines, begin_marker, end_marker)
+
+  if bounds:
+    begin, end = bounds
+    lines[begin:end + 1] = section_lines
+  else:
+    if lines and lines[-1].strip():
+      lines.append("")
+    lines.extend(section_lines)
+
+  return "\n".join(lines) + "\n"
+
+
+def _update_hosts_section(begin_marker, end_marker, mapping):
+  """Rewrites the marked section of the hosts file with mapping. The file is
+  only written if the section actually changed. Returns whether it was
+  written."""
+  with open(_HOSTS_PATH) as hosts_file:
+    content = hosts_file.read()
+
+  section_lines = _generate_section_lines(begin_marker, end_marker, mapping)
+  new_content = _replace_section(content, begin_marker, end_marker,
+                                 section_lines)
+
+  if new_content == content:
+    return False
+
+  _write_atomically(_HOSTS_PATH, new_content)
+  return True
+
+
+def _watch(connection, public, begin_marker, end_marker, interval):
+  """Polls the instances every interval seconds and rewrites the hosts file
+  section whenever the (name, ip) mapping changes. API, network and file
+  errors back off the polling interval, up to _MAX_WATCH_INTERVAL, and a
+  section that couldn't be written is tried again on the next poll."""
+  print("Watching for instance changes every {} seconds".format(interval))
+  last_digest = None
+  delay = interval
+
+  try:
+    while True:
+      try:
+        mapping = sorted(_get_mapping(connection, public))
+        digest = _hash_mapping(mapping)
+        if digest != last_digest:
+          if _update_hosts_section(begin_marker, end_marker, mapping):
+            print("{} Updated {} ({} hosts)".format(
+              time.strftime("%Y-%m-%d %H:%M:%S"), _HOSTS_PATH, len(mapping)))
+          last_digest = digest
+        delay = interval
+      except (EC2ResponseError, EnvironmentError, httplib.HTTPException,
+              subprocess.CalledProcessError) as err:
+        # EnvironmentError covers socket and SSL errors as well as IOError
+        # and OSError from writing the hosts file.
+        delay = min(delay * 2, _MAX_WATCH_INTERVAL)
+        print("{} Could not update {} ({}), retrying in {} seconds".format(
+          time.strftime("%Y-%m-%d %H:%M:%S"), _HOSTS_PATH, err, delay))
+
+      time.sleep(delay)
+  except KeyboardInterrupt:
+    print("Stopped watching")
+
+
+def _write_atomically(path, content):
+  """Replaces the file at path with content by renaming a file from the same
+  directory over it, so readers never see a partially written file. The mode
+  and ownership of the original file are kept. Falls back to sudo when the
+  directory isn't writable."""
+  directory = os.path.dirname(path) or "."
+  original = os.stat(path)
+  mode = stat.S_IMODE(original.st_mode)
+
+  if os.access(directory, os.W_OK):
+    descriptor, temporary_path = tempfile.mkstemp(
+      prefix=".{}.".format(os.path.basename(path)), dir=directory)
+
+    try:
+      with os.fdopen(descriptor, "w") as temporary_file:
+        temporary_file.write(content)
+        temporary_file.flush()
+        os.fsync(temporary_file.fileno())
+
+      os.chmod(temporary_path, mode)
+      temporary = os.stat(temporary_path)
+      if (temporary.st_uid, temporary.st_gid) != (original.st_uid,
+                                                  original.st_gid):
+        os.chown(temporary_path, original.st_uid, original.st_gid)
+
+      os.rename(temporary_path, path)
+    except Exception:
+      if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+      raise
+
+    return
+
+  with tempfile.NamedTemporaryFile(delete=False) as temporary_file:
+    temporary_file.write(content)
+
+  staged_path = os.path.join(directory, ".{}.new".format(
+    os.path.basename(path)))
 
-    if ip_address and name:
-      yield name, ip_address
+  try:
+    # install copies with the right mode and owner, and mv within the same
+    # directory is a rename, so the swap is atomic.
+    subprocess.check_call([
+      "sudo",
+      "install",
+      "-m", "{:o}".format(mode),
+      "-o", str(original.st_uid),
+      "-g", str(original.st_gid),
+      temporary_file.name,
+      staged_path
+    ])
+    subprocess.check_call(["sudo", "mv", "-f", staged_path, path])
+  finally:
+    os.remove(temporary_file.name)
 
 
 if __name__ == "__main__":